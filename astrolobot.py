@@ -1,57 +1,629 @@
 #!/usr/bin/env python3.11
 
-from datetime import datetime,timezone
+from datetime import datetime,timezone,timedelta
 from urllib.parse import quote_plus
-from urllib.request import urlretrieve, urlopen, Request, HTTPError
-from threading import Thread
-from os import makedirs,path
-from functools import cache
-import json,sys,webbrowser,importlib,tomllib
+from urllib.request import urlretrieve
+from threading import Thread, Lock, Event
+from os import makedirs,path,replace
+from functools import cache, lru_cache, wraps
+from collections import OrderedDict, namedtuple
+from array import array
+import json,sys,os,mmap,struct,inspect,time
+
+update_url='https://gitea.sugoidogo.com/SugoiDogo/astrolobot/releases/download/latest/astrolobot.py'
+ephemeris_url='https://github.com/aloistr/swisseph/raw/refs/heads/master/ephe/seas_18.se1'
+fixed_stars_url='https://github.com/aloistr/swisseph/raw/refs/heads/master/ephe/sefstars.txt'
 
 def update():
+    from urllib.request import urlopen, Request, HTTPError
     print('checking for updates...')
     try:
-        with open(script_path()+'astrolobot.py','r') as file:
+        manifest=get_manifest()
+        headers={}
+        if 'update_etag' in manifest:
+            headers['If-None-Match']=manifest['update_etag']
+        try:
+            response=urlopen(Request(update_url,headers=headers))
+        except HTTPError as error:
+            # the release hasn't changed since the last check, so there's nothing to download
+            if error.code==304:
+                print('up to date')
+                return
+            raise
+        updated_script=response.read()
+        with open(script_path()+'astrolobot.py','rb') as file:
             current_script=file.read()
-        urlretrieve(
-            'https://gitea.sugoidogo.com/SugoiDogo/astrolobot/releases/download/latest/astrolobot.py',
-            script_path()+'astrolobot.py'
-        )
-        with open(script_path()+'astrolobot.py','r') as file:
-            updated_script=file.read()
         if current_script==updated_script:
             print('up to date')
         else:
+            with open(script_path()+'astrolobot.py','wb') as file:
+                file.write(updated_script)
             print('update downloaded, restart script to apply')
+        if response.headers.get('ETag'):
+            update_manifest(update_etag=response.headers.get('ETag'))
     except:
         print('update check failed, ignoring')
 
-def dependency_setup():
-    if not path.exists(script_path()+'pip'):
+# Startup functions
+
+# verified requirements and ephemeris files from earlier launches, so repeat launches
+# only stat files instead of hashing them or running pip again
+manifest=None
+manifest_lock=Lock()
+startup_time=time.perf_counter()
+# set once swisseph is configured; astrology functions wait on it while twitch connects
+ephemeris_ready=Event()
+
+def get_manifest():
+    global manifest
+    with manifest_lock:
+        if manifest==None:
+            try:
+                with open(script_path()+'manifest.json','r') as file:
+                    manifest=json.load(file)
+            except (FileNotFoundError, ValueError):
+                manifest={}
+        return manifest
+
+def update_manifest(**values):
+    get_manifest()
+    with manifest_lock:
+        manifest.update(values)
+        with open(script_path()+'manifest.json','w') as file:
+            json.dump(manifest,file,indent=4)
+
+def log_phase(phase, start):
+    print(phase+' ready in '+format(time.perf_counter()-start,'.2f')+'s')
+
+def get_file_hash(file_path):
+    import hashlib
+    file_hash=hashlib.sha256()
+    with open(file_path,'rb') as file:
+        for chunk in iter(lambda: file.read(65536),b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def verify_file(name):
+    stat=os.stat(script_path()+name)
+    files=get_manifest().get('files',{})
+    entry=files.get(name)
+    if entry==None or entry['size']!=stat.st_size or entry['mtime']!=stat.st_mtime:
+        entry={'size':stat.st_size,'mtime':stat.st_mtime,'sha256':get_file_hash(script_path()+name)}
+        update_manifest(files=files|{name:entry})
+    return entry['sha256']
+
+def setup_pip():
+    start=time.perf_counter()
+    requirements=get_file_hash(script_path()+'requirements.txt') if path.exists(script_path()+'requirements.txt') else None
+    if not path.exists(script_path()+'pip') or requirements!=get_manifest().get('requirements'):
         print('installing dependencies')
         from pip._internal.cli.main import main as pip
-        pip(['install','-qq','-r',script_path()+'/requirements.txt','--target',script_path()+'pip'])
-       
-    sys.path.append(script_path()+'pip')
-
+        pip(['install','-qq','-r',script_path()+'/requirements.txt','--target',script_path()+'pip','--upgrade'])
+        update_manifest(requirements=requirements)
+    if script_path()+'pip' not in sys.path:
+        sys.path.append(script_path()+'pip')
+    log_phase('dependencies',start)
+
+def setup_ephemeris_file():
+    start=time.perf_counter()
     if not path.exists(script_path()+'ephe/seas_18.se1'):
         print('downloading database')
-        makedirs(script_path()+'ephe')
-        urlretrieve('https://github.com/aloistr/swisseph/raw/refs/heads/master/ephe/seas_18.se1',script_path()+'ephe/seas_18.se1')
-    
+        makedirs(script_path()+'ephe',exist_ok=True)
+        urlretrieve(ephemeris_url,script_path()+'ephe/seas_18.se1')
+    verify_file('ephe/seas_18.se1')
+    setup_fixed_stars_file()
+    log_phase('database',start)
+
+def setup_fixed_stars_file():
+    # only needed, and only downloaded, once the fixed_stars setting names a star
+    if len(get_setting_list(load_settings(),'fixed_stars'))!=0 and not path.exists(script_path()+'ephe/sefstars.txt'):
+        print('downloading fixed stars')
+        makedirs(script_path()+'ephe',exist_ok=True)
+        urlretrieve(fixed_stars_url,script_path()+'ephe/sefstars.txt')
+
+# swisseph keeps its settings per thread, so every thread that calls it needs this first
+def setup_swisseph_thread():
     import swisseph as swe
     swe.set_ephe_path(script_path()+'ephe/')
     swe.set_sid_mode(swe.SIDM_LAHIRI)
 
+def setup_swisseph():
+    start=time.perf_counter()
+    setup_swisseph_thread()
+    setup_ephemeris_table()
+    ephemeris_ready.set()
+    log_phase('ephemeris',start)
+
+def dependency_setup():
+    # pip and the database download don't depend on each other
+    download=Thread(target=setup_ephemeris_file,daemon=True)
+    download.start()
+    setup_pip()
+    download.join()
+    setup_swisseph()
     print('dependencies ready')
 
 def today():
     now=datetime.utcnow()
     return datetime(now.year,now.month,now.day)
 
+def get_day(date):
+    if date.tzinfo!=None:
+        date=date.astimezone(timezone.utc)
+    return datetime(date.year,date.month,date.day)
+
+seconds_in_1_day=86400
+
+# round a date down to a whole number of seconds since midnight UTC
+def quantize_date(date, resolution):
+    if date.tzinfo!=None:
+        date=date.astimezone(timezone.utc).replace(tzinfo=None)
+    day=get_day(date)
+    seconds=(date-day).total_seconds()
+    return day+timedelta(seconds=seconds-seconds%resolution)
+
+# Result cache
+
+# results of the get_* functions keyed on function name, UTC time rounded down to
+# result_resolution seconds and remaining arguments,
+# evicted least recently used first and after result_cache_ttl seconds
+result_cache=OrderedDict()
+result_cache_lock=Lock()
+result_cache_maxsize=4096
+result_resolution=600
+result_cache_ttl=2*seconds_in_1_day
+result_cache_stats={}
+
+def cached(function=None, persist=False, record=None):
+    # persist is for event lists, see load_events, and record is the namedtuple they are
+    # tuples of, since the store keeps them as lists
+    if function==None:
+        return lambda function: cached(function,persist,record)
+    signature=inspect.signature(function)
+    stats=result_cache_stats.setdefault(function.__name__,{'hits':0,'misses':0,'store_hits':0})
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments=signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        if arguments.arguments['date']==None:
+            arguments.arguments['date']=datetime.utcnow()
+        arguments.arguments['date']=quantize_date(arguments.arguments['date'],result_resolution)
+        key=(function.__name__,)+tuple(arguments.arguments.values())
+        now=time.monotonic()
+        with result_cache_lock:
+            entry=result_cache.get(key)
+            if entry!=None and entry[0]>now:
+                result_cache.move_to_end(key)
+                stats['hits']+=1
+                return entry[1]
+            stats['misses']+=1
+        result=None
+        if persist and result_store_enabled:
+            result=load_events(function.__name__,arguments,record)
+            if result!=None:
+                stats['store_hits']+=1
+            else:
+                result=solve_events(function,arguments)
+        if result==None:
+            result=function(*arguments.args, **arguments.kwargs)
+        with result_cache_lock:
+            result_cache[key]=(now+result_cache_ttl,result)
+            result_cache.move_to_end(key)
+            while len(result_cache)>result_cache_maxsize:
+                result_cache.popitem(last=False)
+        return result
+
+    return wrapper
+
+def get_cache_stats():
+    with result_cache_lock:
+        return {
+            'size':len(result_cache),
+            'maxsize':result_cache_maxsize,
+            'functions':{name:stats.copy() for name, stats in result_cache_stats.items()},
+        }
+
+def clear_result_cache(before=None, functions=None):
+    with result_cache_lock:
+        for key in list(result_cache):
+            if (before==None or key[1]<before) and (functions==None or key[0] in functions):
+                del result_cache[key]
+    if before==None and functions==None:
+        get_body_position_quantized.cache_clear()
+
+# Result store
+
+# event lists that are expensive to compute, kept in SQLite so restarts come up warm, keyed on
+# the function, UTC day and remaining arguments plus a version of everything the result
+# depends on besides its arguments
+result_store=None
+result_store_enabled=True
+result_store_lock=Lock()
+result_store_maxrows=20000
+result_store_writes=0
+
+def get_result_store():
+    import sqlite3
+    global result_store
+    if result_store==None:
+        result_store=sqlite3.connect(script_path()+'results.sqlite3',check_same_thread=False)
+        result_store.execute('PRAGMA journal_mode=WAL')
+        result_store.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)')
+        result_store.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+    return result_store
+
+@cache
+def get_store_version():
+    import hashlib
+    version=json.dumps([
+        get_planets(),
+        get_fixed_stars(),
+        [record._fields for record in (BodyState, BodyPosition, Aspect, BodyEvent, AspectEvent)],
+        major_aspects,
+        minor_aspects,
+        get_manifest().get('files',{}).get('ephe/seas_18.se1',{}).get('sha256'),
+    ],sort_keys=True)
+    return hashlib.sha256(version.encode()).hexdigest()[:16]
+
+def encode_result(value):
+    if isinstance(value,datetime):
+        return {'datetime':value.isoformat()}
+    raise TypeError(type(value).__name__+' is not storable')
+
+def decode_result(value):
+    if len(value)==1 and 'datetime' in value:
+        return datetime.fromisoformat(value['datetime'])
+    return value
+
+def get_store_key(key):
+    return json.dumps([get_store_version()]+list(key),default=encode_result)
+
+# event lists are stored once per UTC day with the julian day they were solved from, and
+# solved a day past their horizon so a restart later that day can still answer from them
+def get_events_key(name, arguments):
+    values=arguments.arguments.copy()
+    return (name,get_day(values.pop('date')))+tuple(values.values())
+
+def load_events(name, arguments, record):
+    stored=load_result(get_events_key(name,arguments))
+    if stored==None:
+        return None
+    solved, events = stored
+    start=get_julian_day(arguments.arguments['date'])
+    # once an event has happened the events after it may have changed too
+    if solved>start or any(event[0]<start for event in events):
+        return None
+    end=start+arguments.arguments['maxdays']
+    return tuple(record(*event) for event in events if event[0]<end)
+
+def solve_events(function, arguments):
+    key=get_events_key(function.__name__,arguments)
+    start=get_julian_day(arguments.arguments['date'])
+    maxdays=arguments.arguments['maxdays']
+    arguments.arguments['maxdays']=maxdays+1
+    events=function(*arguments.args, **arguments.kwargs)
+    arguments.arguments['maxdays']=maxdays
+    store_result(key,[start,events])
+    return tuple(event for event in events if event.julian_day<start+maxdays)
+
+def load_result(key):
+    import sqlite3
+    try:
+        store_key=get_store_key(key)
+        with result_store_lock:
+            store=get_result_store()
+            row=store.execute('SELECT value FROM results WHERE key=?',(store_key,)).fetchone()
+            if row==None:
+                return None
+            store.execute('UPDATE results SET accessed=? WHERE key=?',(time.time(),store_key))
+            store.commit()
+        return json.loads(row[0],object_hook=decode_result)
+    except (sqlite3.Error, OSError, TypeError) as error:
+        print('loading stored result failed: '+repr(error),file=sys.stderr)
+        return None
+
+def store_result(key, value):
+    import sqlite3
+    global result_store_writes
+    try:
+        store_key=get_store_key(key)
+        store_value=json.dumps(value,default=encode_result)
+        with result_store_lock:
+            store=get_result_store()
+            store.execute('INSERT OR REPLACE INTO results VALUES (?,?,?)',(store_key,store_value,time.time()))
+            result_store_writes+=1
+            # counting rows on every write would cost more than the write itself
+            if result_store_writes%64==0:
+                store.execute(
+                    'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT max(0,(SELECT count(*) FROM results)-?))',
+                    (result_store_maxrows,)
+                )
+            store.commit()
+    except (sqlite3.Error, OSError, TypeError) as error:
+        print('storing result failed: '+repr(error),file=sys.stderr)
+
+def prewarm():
+    for locale in get_locales():
+        get_positions_formatted(locale=locale)
+        get_transits_formatted(locale=locale)
+        get_aspects_formatted(locale=locale)
+        get_aspects_formatted(minor=True,locale=locale)
+        get_aspect_transits_formatted(locale=locale)
+        get_aspect_transits_formatted(minor=True,locale=locale)
+
+def prewarm_loop():
+    ephemeris_ready.wait()
+    setup_swisseph_thread()
+    while True:
+        clear_result_cache(before=today())
+        try:
+            prewarm()
+        except Exception as error:
+            print('prewarming results failed: '+repr(error),file=sys.stderr)
+        # wake up just after results roll over to the next quantum
+        time.sleep(result_resolution-time.time()%result_resolution+1)
+
+# Ephemeris table
+
+# angle and speed of every body in get_planets() sampled every ephemeris_table_step days,
+# stored as doubles after a fixed header and read back through a memory map
+ephemeris_table=None
+ephemeris_table_step=1.0
+ephemeris_table_magic=b'ASTROTBL'
+ephemeris_table_header=struct.Struct('<8sIIdd')
+# maximum difference between interpolated and calc_ut values, in degrees and degrees per day
+ephemeris_table_tolerance={'angle':0.01,'speed':0.02}
+
+def ephemeris_table_path():
+    return script_path()+'ephe/astrolobot_table.bin'
+
+def build_ephemeris_table(start, samples, step=ephemeris_table_step):
+    planet_ids=array('q',get_planets().values())
+    data=array('d')
+    for sample in range(samples):
+        julian_day=start+sample*step
+        for planet_id in planet_ids:
+            data.extend(calc_position(julian_day,planet_id))
+    with open(ephemeris_table_path()+'.tmp','wb') as file:
+        file.write(ephemeris_table_header.pack(ephemeris_table_magic,len(planet_ids),samples,start,step))
+        planet_ids.tofile(file)
+        data.tofile(file)
+    replace(ephemeris_table_path()+'.tmp',ephemeris_table_path())
+
+def load_ephemeris_table():
+    try:
+        with open(ephemeris_table_path(),'rb') as file:
+            table_map=mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    magic, body_count, samples, start, step = ephemeris_table_header.unpack_from(table_map)
+    offset=ephemeris_table_header.size
+    planet_ids=array('q',table_map[offset:offset+body_count*8])
+    offset+=body_count*8
+    if magic!=ephemeris_table_magic or len(table_map)!=offset+samples*body_count*16:
+        table_map.close()
+        return None
+    return {
+        'map':table_map,
+        'data':memoryview(table_map)[offset:].cast('d'),
+        'bodies':{planet_id:index for index, planet_id in enumerate(planet_ids)},
+        'start':start,
+        'step':step,
+        'samples':samples,
+    }
+
+def close_ephemeris_table(table):
+    table['data'].release()
+    table['map'].close()
+
+def interpolate_ephemeris_table(table, julian_day, planet_id):
+    index=table['bodies'].get(planet_id)
+    if index==None:
+        return None
+    step=table['step']
+    x=(julian_day-table['start'])/step
+    sample=int(x)
+    if x<0 or sample>=table['samples']-1:
+        return None
+    t=x-sample
+    data=table['data']
+    offset=(sample*len(table['bodies'])+index)*2
+    angle0, speed0 = data[offset], data[offset+1]
+    offset+=len(table['bodies'])*2
+    angle1, speed1 = data[offset], data[offset+1]
+    # unwrap across 0/360 so the cubic hermite spline sees a continuous angle
+    angle1=angle0+(angle1-angle0+180)%360-180
+    t2=t*t
+    t3=t2*t
+    angle=(
+        (2*t3-3*t2+1)*angle0
+        +(t3-2*t2+t)*step*speed0
+        +(3*t2-2*t3)*angle1
+        +(t3-t2)*step*speed1
+    )
+    speed=(
+        (6*t2-6*t)*(angle0-angle1)/step
+        +(3*t2-4*t+1)*speed0
+        +(3*t2-2*t)*speed1
+    )
+    return angle%360, speed
+
+def check_ephemeris_table(table, checks=64):
+    errors={'angle':0.0,'speed':0.0}
+    span=(table['samples']-1)*table['step']
+    for check in range(checks):
+        # offset the samples so they never land exactly on a table row
+        julian_day=table['start']+span*(check+0.37)/checks
+        for planet_id in table['bodies']:
+            angle, speed = interpolate_ephemeris_table(table,julian_day,planet_id)
+            calc_angle, calc_speed = calc_position(julian_day,planet_id)
+            errors['angle']=max(errors['angle'],abs((angle-calc_angle+180)%360-180))
+            errors['speed']=max(errors['speed'],abs(speed-calc_speed))
+    return errors
+
+def setup_ephemeris_table():
+    global ephemeris_table
+    if ephemeris_table!=None:
+        close_ephemeris_table(ephemeris_table)
+        ephemeris_table=None
+    window=load_settings().get('ephemeris_table_years',2)*365.25
+    now=get_julian_day(today())
+    table=load_ephemeris_table()
+    if table!=None:
+        end=table['start']+(table['samples']-1)*table['step']
+        if (
+            set(table['bodies'])!=set(get_planets().values())
+            or table['step']!=ephemeris_table_step
+            or table['start']>now-window/2
+            or end<now+window/2
+        ):
+            close_ephemeris_table(table)
+            table=None
+    if table==None:
+        print('building ephemeris table')
+        samples=int(2*window/ephemeris_table_step)+1
+        build_ephemeris_table(now-window,samples)
+        table=load_ephemeris_table()
+        errors=check_ephemeris_table(table)
+        for key,error in errors.items():
+            if error>ephemeris_table_tolerance[key]:
+                print('ephemeris table '+key+' error '+str(error)+' is above tolerance, using calc_ut',file=sys.stderr)
+                close_ephemeris_table(table)
+                # load_ephemeris_table doesn't check tolerance, so a rejected table can't stay on disk
+                os.remove(ephemeris_table_path())
+                return
+    ephemeris_table=table
+
+# Template functions
+
+# the wording of every reply as str.format templates, which a [templates.<locale>] table in
+# config.toml overrides entry by entry, with its names table translating bodies, signs,
+# aspects and directions and months naming the months in dates
+default_locale='en'
+default_templates={
+    'nothing':'Nothing',
+    'list_separator':', ',
+    'list_pair':'{first} and {last}',
+    'list_many':'{first}, and {last}',
+    'datetime':'{month} {day:02} {hour:02}:{minute:02} UTC',
+    'retrograde_one':'{bodies} is in Retrograde',
+    'retrograde_many':'{bodies} are in Retrograde',
+    'position':'{body} is in {zodiac}',
+    'position_separator':', ',
+    'transit_zodiac':'{body} is entering {zodiac} on {date}',
+    'transit_retrograde':'{body} is entering Retrograde on {date}',
+    'transit_direct':'{body} is exiting Retrograde on {date}',
+    'aspects':'{body} is in {aspects}',
+    'aspect':'{aspect} with {bodies}',
+    'natal_aspect':'{aspect} with natal {bodies}',
+    'aspect_transits':'{body} is {directions}',
+    'aspect_transit':'{direction} {dates}',
+    'aspect_transit_date':'{aspects} on {date}',
+    'announce_zodiac':'{body} is entering {zodiac}',
+    'announce_retrograde':'{body} is entering Retrograde',
+    'announce_direct':'{body} is exiting Retrograde',
+    'announce_exact':'{body_a} is exact {aspect} with {body_b}',
+    'natal_usage':'set yours with {command} set YYYY-MM-DD HH:MM City, then {command} or {command} minor shows its transits',
+    'natal_saved':'natal chart saved for {user}, born {birth}',
+    'natal_unknown_place':'unknown place {place}, try a nearby large city or latitude,longitude',
+    'natal_unsupported_date':'only births from {first} to {last} are supported',
+    'natal_deleted':'natal chart deleted for {user}',
+    'natal_missing':'no natal chart saved for {user}',
+    'natal_nothing':"nothing is in aspect with {user}'s natal chart",
+}
+default_months=('Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec')
+
+def get_template_fields(template):
+    import string
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field!=None}
+
+# fields rendered from numbers, the rest are rendered from text
+template_samples={
+    'datetime':{'day':1,'hour':0,'minute':0},
+    'natal_unsupported_date':{'first':1800,'last':2399},
+}
+
+def compile_template(name, template, locale):
+    default=default_templates[name]
+    # rendered once with sample values, so bad format specs and conversions fail here instead of on every reply
+    samples={field:'x' for field in get_template_fields(default)}
+    samples.update(template_samples.get(name,{}))
+    try:
+        valid=isinstance(template,str) and get_template_fields(template)<=get_template_fields(default)
+        if valid:
+            template.format(**samples)
+    except (ValueError,KeyError,IndexError):
+        valid=False
+    if not valid:
+        print('template '+name+' for locale '+repr(locale)+' is invalid, using '+repr(default),file=sys.stderr)
+        template=default
+    # templates without fields are only joined with, so they're kept as text
+    if get_template_fields(default)==set():
+        return template.format()
+    return template.format
+
+# compiled once per locale so rendering is only lookups and format calls,
+# cleared by clear_templates when settings change
+@cache
+def get_templates(locale=default_locale):
+    overrides=load_settings().get('templates',{}).get(locale,{})
+    if locale!=default_locale and overrides=={}:
+        print('no templates for locale '+repr(locale)+', using '+default_locale,file=sys.stderr)
+    templates={
+        name:compile_template(name,overrides.get(name,template),locale)
+        for name, template in default_templates.items()
+    }
+    months=overrides.get('months',default_months)
+    if len(months)!=12:
+        print('months for locale '+repr(locale)+' is not 12 names, using '+default_locale,file=sys.stderr)
+        months=default_months
+    names=overrides.get('names',{})
+    templates['months']=tuple(months)
+    templates['names']=names
+    templates['body_names']=tuple(names.get(name,name) for name in get_body_names())
+    templates['aspect_names']=tuple(names.get(name,name) for name in get_aspect_names())
+    return templates
+
+# replies rendered from templates, which the result cache keeps per date quantum and locale
+rendered_functions=('get_positions_formatted','get_transits_formatted','get_aspects_formatted','get_aspect_transits_formatted')
+
+def clear_templates():
+    get_templates.cache_clear()
+    clear_result_cache(functions=rendered_functions)
+    reset_worker_pool()
+
+def get_locales():
+    # every locale a channel replies in, so prewarm renders each of them
+    channels=load_settings().get('channels',{})
+    return {get_channel_settings(channel).get('locale',default_locale) for channel in [None]+list(channels)}
+
+def get_list_rendered(templates, items):
+    match len(items):
+        case 0:
+            return templates['nothing']
+        case 1:
+            return items[0]
+        case 2:
+            return templates['list_pair'](first=items[0],last=items[1])
+        case _:
+            return templates['list_many'](first=templates['list_separator'].join(items[0:-1]),last=items[-1])
+
+def get_date_rendered(templates, julian_day):
+    date=get_date(julian_day)
+    return templates['datetime'](month=templates['months'][date.month-1],day=date.day,hour=date.hour,minute=date.minute)
+
+def get_aspect_list_rendered(templates, aspects, template='aspect'):
+    # aspects is {aspect:[bodies]} in the locale's names
+    return get_list_rendered(templates,[
+        templates[template](aspect=aspect,bodies=get_list_rendered(templates,bodies))
+        for aspect, bodies in aspects.items()
+    ])
+
 # Astrology functions
 
 def load_settings():
+    import tomllib
     try:
         with open(script_path()+'config.toml','r') as file:
             return tomllib.loads(file.read())
@@ -63,8 +635,28 @@ def load_settings():
             'minor_aspects':'!aspects minor',
             'major_aspect_transits':'!aspects major transits',
             'minor_aspect_transits':'!aspects minor transits',
+            'ephemeris_table_years':2,
+            'worker_pool':'thread',
+            'chat_rate_limit':20,
+            'chat_rate_window':30,
+            'announcements':False,
+            'announce_minor_aspects':False,
+            'natal':'!natal',
+            'bodies':[],
+            'fixed_stars':[],
+            'http_server':False,
+            'http_host':'127.0.0.1',
+            'http_port':8642,
+            'locale':'en',
         }
 
+def get_setting_list(settings, name):
+    # a list in config.toml, comma separated text in OBS
+    value=settings.get(name,[])
+    if isinstance(value,str):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return value
+
 def get_zodiac(angle):
     zodiac = ["Aries", "Taurus", "Gemini", "Cancer", "Leo", "Virgo", 
         "Libra", "Scorpio", "Sagittarius", "Capricorn", "Aquarius", "Pisces"]
@@ -73,11 +665,20 @@ def get_zodiac(angle):
 def is_retrograde(speed):
     return speed<0
 
+# bodies the bodies setting can add to the defaults, and their swisseph constants
+optional_bodies={
+    'Ceres':'CERES',
+    'Pallas':'PALLAS',
+    'Juno':'JUNO',
+    'Vesta':'VESTA',
+    'Lilith':'MEAN_APOG',
+}
+
+# cached since every position lookup needs it, cleared by setup_bodies when settings change
 @cache
-def get_positions_raw(date=today()):
+def get_planets():
     import swisseph as swe
-    julian_day = swe.julday(date.year, date.month, date.day)
-    planets = {
+    planets={
         "The Sun": swe.SUN,
         "The Moon": swe.MOON,
         "Mercury": swe.MERCURY,
@@ -89,310 +690,1443 @@ def get_positions_raw(date=today()):
         "Neptune": swe.NEPTUNE,
         "Pluto": swe.PLUTO,
         "Chiron": swe.CHIRON,
-        "North Node":swe.TRUE_NODE
     }
-    positions={}
+    for name in get_setting_list(load_settings(),'bodies'):
+        if name in optional_bodies:
+            planets[name]=getattr(swe,optional_bodies[name])
+        else:
+            print('unknown body '+repr(name)+', expected one of '+', '.join(optional_bodies),file=sys.stderr)
+    # the nodes stay last, since get_aspect_pairs never pairs a node with a later body
+    planets["North Node"]=swe.TRUE_NODE
+    return planets
 
-    for planet_name, planet_id in planets.items():
-        position, _ = swe.calc_ut(julian_day, planet_id, swe.FLG_SPEED)
-        positions[planet_name]={
-            'angle':position[0],
-            'speed':position[3],
-        }
-        if planet_name=='North Node':
-            positions['South Node']={
-                'angle':(position[0]+180)%360,
-                'speed':position[3],
-            }
+# names from sefstars.txt, added to the bodies between the planets and the nodes, without
+# the ones swisseph can't find, which would otherwise fail every position lookup
+@cache
+def get_fixed_stars():
+    import swisseph as swe
+    # the first call can come from any thread
+    setup_swisseph_thread()
+    stars=[]
+    for name in get_setting_list(load_settings(),'fixed_stars'):
+        try:
+            swe.fixstar2_ut(name, 2451545.0)
+        except swe.Error as error:
+            print('unknown fixed star '+repr(name)+', '+str(error),file=sys.stderr)
+            continue
+        stars.append(name)
+    return tuple(stars)
+
+def setup_bodies():
+    # newly named stars are only found once their file is there
+    try:
+        setup_fixed_stars_file()
+    except OSError as error:
+        print('downloading fixed stars failed: '+repr(error),file=sys.stderr)
+    # the ephemeris table keeps serving the bodies it has and the rest fall back to calc_ut
+    # until the next startup rebuilds it for the new set
+    bodies=(tuple(get_planets()),get_fixed_stars())
+    get_planets.cache_clear()
+    get_fixed_stars.cache_clear()
+    if (tuple(get_planets()),get_fixed_stars())==bodies:
+        return
+    get_body_names.cache_clear()
+    get_body_ids.cache_clear()
+    get_store_version.cache_clear()
+    get_templates.cache_clear()
+    clear_result_cache()
+    clear_timelines()
+    reset_worker_pool()
+
+def get_julian_day(date):
+    import swisseph as swe
+    if date.tzinfo!=None:
+        date=date.astimezone(timezone.utc)
+    hour=date.hour+date.minute/60+date.second/3600+date.microsecond/3600e6
+    return swe.julday(date.year, date.month, date.day, hour)
 
-    return positions
+def calc_position(julian_day, planet_id):
+    import swisseph as swe
+    start=time.perf_counter()
+    position, _ = swe.calc_ut(julian_day, planet_id, swe.FLG_SPEED)
+    observe('astrolobot_calc_ut_seconds',time.perf_counter()-start)
+    return position[0],position[3]
+
+def get_position(julian_day, planet_id):
+    if ephemeris_table!=None:
+        position=interpolate_ephemeris_table(ephemeris_table,julian_day,planet_id)
+        if position!=None:
+            return position
+    return calc_position(julian_day,planet_id)
+
+def calc_fixed_star(julian_day, name):
+    import swisseph as swe
+    position, _, _ = swe.fixstar2_ut(name, julian_day)
+    # the apparent speed swings negative with aberration, which isn't a retrograde,
+    # so fixed stars report the precession rate instead
+    return position[0],fixed_star_speed
+
+# seconds each body's position is rounded down to, so slow bodies are computed once an hour
+# or day while the Moon, at about 0.5 degrees an hour, stays within a few arcminutes
+body_resolution={
+    'The Moon':600,
+    'The Sun':3600,
+    'Mercury':3600,
+    'Venus':3600,
+    'Mars':3600,
+    'North Node':3600,
+    'Jupiter':seconds_in_1_day,
+    'Saturn':seconds_in_1_day,
+    'Uranus':seconds_in_1_day,
+    'Neptune':seconds_in_1_day,
+    'Pluto':seconds_in_1_day,
+    'Chiron':seconds_in_1_day,
+    'Lilith':seconds_in_1_day,
+}
+body_resolution_default=3600
+
+def get_body_resolution(name):
+    if name in get_fixed_stars():
+        return seconds_in_1_day
+    return body_resolution.get(name,body_resolution_default)
+
+@lru_cache(maxsize=4096)
+def get_body_position_quantized(date, name):
+    return get_body_position(get_julian_day(date), name)
+
+# immutable records, so a cached result can be shared by every caller without copying,
+# with bodies and aspects as integer ids into get_body_names and get_aspect_names
+# that are only turned into names for output
+BodyState=namedtuple('BodyState',['angle','speed'])
+BodyPosition=namedtuple('BodyPosition',['body','zodiac','retrograde'])
+Aspect=namedtuple('Aspect',['body_a','aspect','body_b'])
+BodyEvent=namedtuple('BodyEvent',['julian_day','body','kind','value'])
+AspectEvent=namedtuple('AspectEvent',['julian_day','body_a','body_b','aspect','direction'])
 
 @cache
-def get_positions(date=today()):
-    positions={}
+def get_body_ids():
+    return {name:body for body, name in enumerate(get_body_names())}
+
+def get_record_dict(record):
+    # a record with names and a date in place of ids and a julian day, for JSON output
+    names=get_body_names()
+    values={}
+    for field, value in zip(record._fields, record):
+        if field=='julian_day':
+            values['date']=get_date(value)
+        elif field in ('body','body_a','body_b'):
+            values[field]=names[value]
+        elif field=='aspect':
+            values[field]=get_aspect_names()[value]
+        else:
+            values[field]=value
+    return values
 
-    for name, position_raw in get_positions_raw(date).items():
-        positions[name]={
-            'zodiac':get_zodiac(position_raw['angle']),
-            'retrograde':is_retrograde(position_raw['speed']),
-        }
+# one BodyState per body, indexed by body id, not persisted since the ephemeris table
+# already makes these cheap
+@cached
+def get_positions_raw(date=None):
+    positions=[]
 
-    return positions
+    for name in get_body_names():
+        positions.append(BodyState(*get_body_position_quantized(quantize_date(date,get_body_resolution(name)), name)))
 
-def get_list_formatted(in_list,isare=False):
-    match len(in_list):
-        case 0:
-            output='Nothing'
-            if isare:
-                output+=' is '
-        case 1:
-            output=in_list[0]
-            if isare:
-                output+=' is '
-        case 2:
-            output=' and '.join(in_list)
-            if isare:
-                output+=' are '
-        case _:
-            output=', '.join(in_list[0:-1])+', and '+in_list[-1]
-            if isare:
-                output+=' are '
-    return output
+    return tuple(positions)
 
-@cache
-def get_positions_formatted(date=today()):
-    retrograde_planets=[]
-    position_strings=[]
+@cached
+def get_positions(date=None):
+    positions=[]
 
-    for name, position in get_positions(date).items():
-        if(position['retrograde']):
-            retrograde_planets.append(name)
-        position_strings.append(name+' is in '+position['zodiac'])
-    
-    positions_formatted=get_list_formatted(retrograde_planets,True)+'in Retrograde\n'
+    for body, position_raw in enumerate(get_positions_raw(date)):
+        positions.append(BodyPosition(body,get_zodiac(position_raw.angle),is_retrograde(position_raw.speed)))
 
-    positions_formatted+=', '.join(position_strings[0:2])+'\n'
-    positions_formatted+=', '.join(position_strings[2:5])+'\n'
-    positions_formatted+=', '.join(position_strings[5:8])+'\n'
-    positions_formatted+=', '.join(position_strings[8:11])+'\n'
-    positions_formatted+=', '.join(position_strings[11:13])+'\n'
-    
-    return positions_formatted
+    return tuple(positions)
 
-seconds_in_1_day=86400
+@cached
+def get_positions_formatted(date=None, locale=default_locale):
+    templates=get_templates(locale)
+    names=templates['body_names']
+    zodiac=templates['names']
+    retrograde_planets=[]
+    position_strings=[]
 
+    for position in get_positions(date):
+        if(position.retrograde):
+            retrograde_planets.append(names[position.body])
+        position_strings.append(templates['position'](body=names[position.body],zodiac=zodiac.get(position.zodiac,position.zodiac)))
+
+    retrograde=templates['retrograde_many' if len(retrograde_planets)>1 else 'retrograde_one']
+    separator=templates['position_separator']
+    lines=[retrograde(bodies=get_list_rendered(templates,retrograde_planets)),separator.join(position_strings[0:2])]
+    for index in range(2,len(position_strings),3):
+        lines.append(separator.join(position_strings[index:index+3]))
+
+    return ''.join(line+'\n' for line in lines)
+
+# fastest motion of each body in degrees per day, and for bodies that station a step
+# shorter than their shortest retrograde or direct phase so no station is stepped over
+body_motion={
+    'The Sun':{'speed':1.03,'station_step':None},
+    'The Moon':{'speed':15.5,'station_step':None},
+    'Mercury':{'speed':2.25,'station_step':5},
+    'Venus':{'speed':1.3,'station_step':10},
+    'Mars':{'speed':0.8,'station_step':15},
+    'Jupiter':{'speed':0.25,'station_step':30},
+    'Saturn':{'speed':0.14,'station_step':30},
+    'Uranus':{'speed':0.07,'station_step':30},
+    'Neptune':{'speed':0.05,'station_step':30},
+    'Pluto':{'speed':0.05,'station_step':30},
+    'Chiron':{'speed':0.15,'station_step':20},
+    'North Node':{'speed':0.3,'station_step':0.25},
+    'South Node':{'speed':0.3,'station_step':0.25},
+    'Ceres':{'speed':1.0,'station_step':20},
+    'Pallas':{'speed':1.0,'station_step':20},
+    'Juno':{'speed':1.0,'station_step':20},
+    'Vesta':{'speed':1.0,'station_step':20},
+    'Lilith':{'speed':0.12,'station_step':None},
+}
+# fixed stars precess about 50 arcseconds a year and never station
+fixed_star_speed=50.29/3600/365.25
+fixed_star_motion={'speed':0.001,'station_step':None}
+
+def get_body_motion(name):
+    return body_motion.get(name,fixed_star_motion)
+# events are solved to within ten seconds
+event_precision=10/seconds_in_1_day
+event_min_step=0.05
+
+def get_date(julian_day):
+    return datetime(2000,1,1,12,tzinfo=timezone.utc)+timedelta(days=julian_day-2451545.0)
+
+def get_angle_diff(angle_a, angle_b):
+    return (angle_a-angle_b+180)%360-180
+
+def get_body_position(julian_day, name):
+    planets=get_planets()
+    if name=='South Node':
+        angle, speed = get_position(julian_day, planets['North Node'])
+        return (angle+180)%360, speed
+    if name in planets:
+        return get_position(julian_day, planets[name])
+    return calc_fixed_star(julian_day, name)
+
+def find_crossing(function, start, end):
+    value_start=function(start)<0
+    while end-start>event_precision:
+        middle=(start+end)/2
+        if (function(middle)<0)==value_start:
+            start=middle
+        else:
+            end=middle
+    return end
+
+def get_body_events(name, start, end):
+    motion=get_body_motion(name)
+    julian_day=start
+    angle, speed = get_body_position(julian_day, name)
+
+    while julian_day<end:
+        # the body can't reach the next sign boundary any sooner than this
+        distance=min(angle%30, 30-angle%30)
+        step=max(distance/motion['speed'], event_min_step)
+        if motion['station_step']!=None:
+            step=min(step, motion['station_step'])
+        next_julian_day=min(julian_day+step, end)
+        next_angle, next_speed = get_body_position(next_julian_day, name)
+        events=[]
+
+        if int(angle//30)!=int(next_angle//30):
+            if get_angle_diff(next_angle, angle)>0:
+                boundary=(angle//30+1)*30%360
+                zodiac=get_zodiac(boundary)
+            else:
+                boundary=angle//30*30
+                zodiac=get_zodiac((boundary-15)%360)
+            crossing=find_crossing(
+                lambda julian_day: get_angle_diff(get_body_position(julian_day, name)[0], boundary),
+                julian_day, next_julian_day
+            )
+            events.append((crossing, 'zodiac', zodiac))
+
+        if is_retrograde(speed)!=is_retrograde(next_speed):
+            crossing=find_crossing(
+                lambda julian_day: get_body_position(julian_day, name)[1],
+                julian_day, next_julian_day
+            )
+            events.append((crossing, 'retrograde', is_retrograde(next_speed)))
+
+        yield from sorted(events)
+        julian_day, angle, speed = next_julian_day, next_angle, next_speed
+
+# the next BodyEvent of each body, in time order
+@cached(persist=True, record=BodyEvent)
+def get_transits(date=None, maxdays=365):
+    from functools import partial
+    start=get_julian_day(date)
+    transits=[]
+
+    for body, name in enumerate(get_body_names()):
+        timeline=get_timeline(('body',name),partial(get_body_timeline_events,bodies=(body,)))
+        # only solved up to the body's first event, not the whole year
+        events=timeline.advance(start, start+maxdays, timeline_step, lambda events: len(events)!=0)
+        if len(events)!=0:
+            transits.append(events[0])
+
+    return tuple(sorted(transits))
+
+@cached
+def get_transits_formatted(date=None, maxdays=365, locale=default_locale):
+    templates=get_templates(locale)
+    names=templates['body_names']
+    zodiac=templates['names']
+    lines=[]
+
+    for transit in get_transits(date, maxdays):
+        name=names[transit.body]
+        transit_date=get_date_rendered(templates,transit.julian_day)
+        if transit.kind=='zodiac':
+            lines.append(templates['transit_zodiac'](body=name,zodiac=zodiac.get(transit.value,transit.value),date=transit_date))
+        elif transit.value:
+            lines.append(templates['transit_retrograde'](body=name,date=transit_date))
+        else:
+            lines.append(templates['transit_direct'](body=name,date=transit_date))
+
+    return ''.join(line+'\n' for line in lines)
+
+major_aspects={
+    'conjuction':{'angle':0,'orb':10.0},
+    'oposition':{'angle':180,'orb':10.0},
+    'trine':{'angle':120,'orb':10.0},
+    'square':{'angle':90,'orb':10.0},
+    'sextile':{'angle':60,'orb':5.0},
+}
+minor_aspects={
+    'semi-sextile':{'angle':30,'orb':1.5},
+    'inconjunct':{'angle':150,'orb':3},
+    'semi-square':{'angle':45,'orb':3},
+    'trioctile':{'angle':135,'orb':3},
+    'quintile':{'angle':72,'orb':1},
+    'biquintile':{'angle':144,'orb':1},
+}
+
+def get_aspect_table(minor=False):
+    if minor:
+        return minor_aspects
+    return major_aspects
+
+# major then minor aspects, so one id names an aspect from either table
 @cache
-def get_transits(date=today(), maxdays=28):
-    positions_now=get_positions(date)
-    transits={}
-    days=1
-
-    while len(transits)<12 and days<=maxdays:
-        future_timestamp=date.timestamp()+(days*seconds_in_1_day)
-        future_date=datetime.fromtimestamp(future_timestamp,timezone.utc)
-        positions_future=get_positions(future_date)
-        for name, position_future in positions_future.items():
-            position_now=positions_now[name]
-            if name not in transits and position_now!=position_future:
-                position_future['date']=future_date
-                if position_now['zodiac']==position_future['zodiac']:
-                    position_future['zodiac']=None
-                if position_now['retrograde']==position_future['retrograde']:
-                    position_future['retrograde']=None
-                transits[name]=position_future
-        days+=1
-    
-    return transits
+def get_aspect_names():
+    return tuple(major_aspects)+tuple(minor_aspects)
 
-date_format='%b %d'
+@cache
+def get_aspect_ids():
+    return {name:aspect for aspect, name in enumerate(get_aspect_names())}
 
 @cache
-def get_transits_formatted(date=today(), maxdays=28):
-    transits_formatted=''
-
-    for name,transit in get_transits(date, maxdays).items():
-        if transit['zodiac']!=None:
-            transits_formatted+=name+' is entering '+transit['zodiac']+' on '+transit['date'].strftime(date_format)+'\n'
-        if transit['retrograde']==True:
-            transits_formatted+=name+' is entering Retrograde on '+transit['date'].strftime(date_format)+'\n'
-        if transit['retrograde']==False:
-            transits_formatted+=name+' is exiting Retrograde on '+transit['date'].strftime(date_format)+'\n'
-        
-    return transits_formatted
+def get_aspect_lookup(minor=False):
+    # aspects whose orb overlaps each whole degree of separation, so a pair only
+    # checks the one or two aspects near its separation instead of the whole table
+    lookup=[[] for degree in range(181)]
+    for aspect_name, aspect in get_aspect_table(minor).items():
+        aspect_min=aspect['angle']-aspect['orb']
+        aspect_max=aspect['angle']+aspect['orb']
+        for degree in range(max(int(aspect_min),0), min(int(aspect_max),180)+1):
+            lookup[degree].append((aspect_name,aspect_min,aspect_max))
+    return lookup
+
+def get_aspects_batch(names, longitudes, minor=False):
+    # longitudes holds one sequence of angles per body, one angle per timestep,
+    # and the result holds one list of (index_a, aspect id, index_b) per timestep, with
+    # indexes into names, in the same order get_aspect_pairs would find them
+    from bisect import bisect_left, bisect_right
+    windows=[]
+    for aspect_name, aspect in get_aspect_table(minor).items():
+        # a window that overlaps its mirror image finds each pair from both bodies
+        mirrored=aspect['angle']-aspect['orb']<0 or aspect['angle']+aspect['orb']>180
+        windows.append((get_aspect_ids()[aspect_name],aspect['angle']-aspect['orb'],2*aspect['orb'],mirrored))
+    nodes=[name.endswith('Node') for name in names]
+    count=len(names)
+    batch=[]
+
+    for angles in zip(*longitudes):
+        # with the angles sorted, the bodies ahead of each body by an aspect's angle sit in
+        # one window, so only pairs actually in orb are visited instead of every pair
+        order=sorted(range(count), key=angles.__getitem__)
+        swept=[angles[index] for index in order]
+        first=swept[0]
+        # the circle twice over, so windows past 360 degrees don't wrap
+        swept+=[angle+360 for angle in swept]
+        found=[]
+        for aspect, offset, width, mirrored in windows:
+            for index_a in order:
+                low=first+(angles[index_a]+offset-first)%360
+                for position in range(bisect_right(swept,low), bisect_left(swept,low+width)):
+                    index_b=order[position%count]
+                    if index_a==index_b or (mirrored and index_a>index_b):
+                        continue
+                    if index_a<index_b:
+                        if not nodes[index_a]:
+                            found.append((index_a,index_b,aspect))
+                    elif not nodes[index_b]:
+                        found.append((index_b,index_a,aspect))
+        found.sort()
+        batch.append([(index_a,aspect,index_b) for index_a, index_b, aspect in found])
+
+    return batch
+
+@cached
+def get_aspects(date=None, minor=False):
+    longitudes=[[position.angle] for position in get_positions_raw(date)]
+    aspects=[]
+
+    for body_a, aspect, body_b in get_aspects_batch(get_body_names(), longitudes, minor)[0]:
+        aspects.append(Aspect(body_a,aspect,body_b))
+
+    return tuple(aspects)
+
+@cached
+def get_aspects_formatted(date=None, minor=False, locale=default_locale):
+    templates=get_templates(locale)
+    names=templates['body_names']
+    aspect_names=templates['aspect_names']
+    grouped={}
+
+    for aspect in get_aspects(date,minor):
+        grouped.setdefault(names[aspect.body_a],{}).setdefault(aspect_names[aspect.aspect],[]).append(names[aspect.body_b])
+
+    return ''.join(
+        templates['aspects'](body=planet,aspects=get_aspect_list_rendered(templates,aspects))+'\n'
+        for planet, aspects in grouped.items()
+    )
 
+def get_aspect_pairs(names):
+    pairs=[]
+    for index, name_a in enumerate(names):
+        if name_a.endswith('Node'):
+            continue
+        for name_b in names[index+1:]:
+            pairs.append((name_a,name_b))
+    return pairs
+
+def get_aspect_targets(aspects):
+    # signed separations, as returned by get_angle_diff, where a pair enters or exits
+    # the orb of an aspect or the aspect is exact
+    targets=set()
+    for aspect_name, aspect in aspects.items():
+        for kind, separation in (
+            ('orb',aspect['angle']-aspect['orb']),
+            ('exact',aspect['angle']),
+            ('orb',aspect['angle']+aspect['orb']),
+        ):
+            separation=abs(separation)
+            if separation>180:
+                separation=360-separation
+            targets.add((separation,kind,aspect_name))
+            if 0<separation<180:
+                targets.add((-separation,kind,aspect_name))
+    return sorted(targets)
+
+def in_orb(separation, aspect):
+    return aspect['angle']-aspect['orb']<abs(separation)<aspect['angle']+aspect['orb']
+
+def get_pair_separation(julian_day, name_a, name_b):
+    return get_angle_diff(get_body_position(julian_day, name_a)[0], get_body_position(julian_day, name_b)[0])
+
+def get_pair_events(name_a, name_b, aspects, start, end):
+    speed=get_body_motion(name_a)['speed']+get_body_motion(name_b)['speed']
+    julian_day=start
+    separation=get_pair_separation(julian_day, name_a, name_b)
+
+    def get_distance(separation, targets):
+        return min(abs(get_angle_diff(separation,target)) for target,_,_ in targets)
+
+    # the pair can't close the gap to any target within the horizon
+    if len(aspects)==0 or get_distance(separation, get_aspect_targets(aspects))>speed*(end-start):
+        return
+
+    # aspects may be removed by the caller between events to stop searching for them
+    while julian_day<end and len(aspects)!=0:
+        targets=get_aspect_targets(aspects)
+        step=max(get_distance(separation, targets)/speed, event_min_step)
+        next_julian_day=min(julian_day+step, end)
+        next_separation=get_pair_separation(next_julian_day, name_a, name_b)
+        events=[]
+
+        for target, kind, aspect_name in targets:
+            diff=get_angle_diff(separation, target)
+            next_diff=get_angle_diff(next_separation, target)
+            # a sign change across the far side of the circle is a wrap, not a crossing
+            if (diff<0)==(next_diff<0) or abs(diff)+abs(next_diff)>=180:
+                continue
+            crossing=find_crossing(
+                lambda julian_day: get_angle_diff(get_pair_separation(julian_day, name_a, name_b), target),
+                julian_day, next_julian_day
+            )
+            if kind=='exact':
+                direction='exact'
+            elif in_orb(get_pair_separation(crossing, name_a, name_b), aspects[aspect_name]):
+                direction='entering'
+            else:
+                direction='exiting'
+            events.append((crossing, aspect_name, direction))
+
+        yield from sorted(events)
+        julian_day, separation = next_julian_day, next_separation
+
+# days a timeline first grows its window by, doubling each time until the query is resolved
+timeline_step=1
+
+class Timeline:
+    # future events sorted by time, so moving the window forward drops the past events
+    # and only computes the newly exposed tail instead of the whole window
+
+    def __init__(self, source):
+        self.source=source
+        self.events=[]
+        self.start=None
+        self.end=None
+        self.lock=Lock()
+
+    def advance(self, start, end, step=None, resolved=None):
+        # the window only grows until resolved(events) holds or it reaches end, so a query
+        # for the next few events doesn't pay for solving every event up to end
+        from bisect import bisect_left
+        if step==None:
+            step=end-start
+        if resolved==None:
+            resolved=lambda events: False
+        with self.lock:
+            if self.start==None or start<self.start or start>self.end:
+                self.events=[]
+                self.start, self.end = start, start
+            else:
+                del self.events[:bisect_left(self.events,(start,))]
+                self.start=start
+            while self.end<end and not resolved(self.events):
+                next_end=min(self.end+step, end)
+                self.events.extend(sorted(self.source(self.end, next_end)))
+                self.end=next_end
+                step*=2
+            return self.events[:bisect_left(self.events,(end,))]
+
+# body ids are indexes into this, cleared with get_planets by setup_bodies
 @cache
-def get_aspects(date=today(), minor=False):
-    positions=get_positions_raw(date).copy()
-    major_aspects={
-        'conjuction':{'angle':0,'orb':10.0},
-        'oposition':{'angle':180,'orb':10.0},
-        'trine':{'angle':120,'orb':10.0},
-        'square':{'angle':90,'orb':10.0},
-        'sextile':{'angle':60,'orb':5.0},
+def get_body_names():
+    return tuple(get_planets())[:-1]+get_fixed_stars()+('North Node','South Node')
+
+def get_body_timeline_events(start, end, bodies=None):
+    names=get_body_names()
+    for body in range(len(names)) if bodies==None else bodies:
+        for julian_day, kind, value in get_body_events(names[body], start, end):
+            yield BodyEvent(julian_day, body, kind, value)
+
+def get_pair_timeline_events(minor, start, end):
+    body_ids=get_body_ids()
+    aspect_ids=get_aspect_ids()
+    for name_a, name_b in get_aspect_pairs(get_body_names()):
+        for julian_day, aspect, direction in get_pair_events(name_a, name_b, get_aspect_table(minor), start, end):
+            yield AspectEvent(julian_day, body_ids[name_a], body_ids[name_b], aspect_ids[aspect], direction)
+
+def get_pair_transit_events(name_a, name_b, active, aspects, start, end):
+    # aspects in orb now report when they perfect and exit, the rest only when they next enter,
+    # and each is removed from aspects once it has so the pair stops searching for it
+    body_ids=get_body_ids()
+    aspect_ids=get_aspect_ids()
+    for julian_day, aspect, direction in get_pair_events(name_a, name_b, aspects, start, end):
+        if aspect not in aspects or (direction=='entering')==active[aspect]:
+            continue
+        if direction!='exact':
+            del aspects[aspect]
+        yield AspectEvent(julian_day, body_ids[name_a], body_ids[name_b], aspect_ids[aspect], direction)
+
+# a timeline per body and per pair, so each stops growing once its own query is resolved
+timelines={}
+timelines_lock=Lock()
+
+def get_timeline(key, source):
+    with timelines_lock:
+        if key not in timelines:
+            timelines[key]=Timeline(source)
+        return timelines[key]
+
+def get_pair_timeline(minor, name_a, name_b, active):
+    from functools import partial
+    # a pair's timeline only holds the events that resolve its aspects from this active state,
+    # so it's rebuilt for the pair alone once an event passes and the state changes
+    key=('pair',minor,name_a,name_b)
+    state=tuple(sorted(active.items()))
+    with timelines_lock:
+        entry=timelines.get(key)
+        if entry==None or entry[0]!=state:
+            source=partial(get_pair_transit_events, name_a, name_b, active, get_aspect_table(minor).copy())
+            entry=timelines[key]=(state, Timeline(source))
+        return entry[1]
+
+def clear_timelines():
+    with timelines_lock:
+        timelines.clear()
+
+# AspectEvents in time order
+@cached(persist=True, record=AspectEvent)
+def get_aspect_transits(date=None,minor=False,maxdays=28):
+    start=get_julian_day(date)
+    aspect_transits=[]
+
+    for name_a, name_b in get_aspect_pairs(get_body_names()):
+        separation=get_pair_separation(start, name_a, name_b)
+        active={aspect_name:in_orb(separation, aspect) for aspect_name, aspect in get_aspect_table(minor).items()}
+        aspect_transits.extend(get_pair_timeline(minor, name_a, name_b, active).advance(start, start+maxdays))
+
+    return tuple(sorted(aspect_transits))
+
+@cached
+def get_aspect_transits_formatted(date=None, minor=False, maxdays=28, locale=default_locale):
+    templates=get_templates(locale)
+    names=templates['body_names']
+    aspect_names=templates['aspect_names']
+    # most transits share their date with another, so each date is rendered once
+    dates={}
+    grouped={}
+
+    for aspect_transit in get_aspect_transits(date,minor,maxdays):
+        transit_date=dates.get(aspect_transit.julian_day)
+        if transit_date==None:
+            transit_date=dates[aspect_transit.julian_day]=get_date_rendered(templates,aspect_transit.julian_day)
+        directions=grouped.setdefault(names[aspect_transit.body_a],{})
+        aspects=directions.setdefault(aspect_transit.direction,{}).setdefault(transit_date,{})
+        aspects.setdefault(aspect_names[aspect_transit.aspect],[]).append(names[aspect_transit.body_b])
+
+    lines=[]
+
+    for planet_a,directions in grouped.items():
+        direction_list=[]
+        for direction,transit_dates in directions.items():
+            date_list=[
+                templates['aspect_transit_date'](aspects=get_aspect_list_rendered(templates,aspects),date=transit_date)
+                for transit_date, aspects in transit_dates.items()
+            ]
+            direction_name=templates['names'].get(direction,direction)
+            direction_list.append(templates['aspect_transit'](direction=direction_name,dates=get_list_rendered(templates,date_list)))
+        lines.append(templates['aspect_transits'](body=planet_a,directions=get_list_rendered(templates,direction_list)))
+
+    return ''.join(line+'\n' for line in lines)
+
+# Natal functions
+
+# first and last birth years seas_18.se1 covers, since Chiron and the asteroids need it
+natal_years=(1800,2399)
+
+# latitude, longitude and time zone of places viewers can give as a birthplace,
+# lower case, so registering never depends on a geocoding service
+gazetteer={
+    'amsterdam':(52.37,4.90,'Europe/Amsterdam'),
+    'athens':(37.98,23.73,'Europe/Athens'),
+    'atlanta':(33.75,-84.39,'America/New_York'),
+    'auckland':(-36.85,174.76,'Pacific/Auckland'),
+    'bangkok':(13.76,100.50,'Asia/Bangkok'),
+    'barcelona':(41.39,2.17,'Europe/Madrid'),
+    'beijing':(39.90,116.41,'Asia/Shanghai'),
+    'berlin':(52.52,13.40,'Europe/Berlin'),
+    'bogota':(4.71,-74.07,'America/Bogota'),
+    'boston':(42.36,-71.06,'America/New_York'),
+    'brussels':(50.85,4.35,'Europe/Brussels'),
+    'buenos aires':(-34.60,-58.38,'America/Argentina/Buenos_Aires'),
+    'cairo':(30.04,31.24,'Africa/Cairo'),
+    'cape town':(-33.92,18.42,'Africa/Johannesburg'),
+    'chicago':(41.88,-87.63,'America/Chicago'),
+    'copenhagen':(55.68,12.57,'Europe/Copenhagen'),
+    'dallas':(32.78,-96.80,'America/Chicago'),
+    'delhi':(28.61,77.21,'Asia/Kolkata'),
+    'denver':(39.74,-104.99,'America/Denver'),
+    'dubai':(25.20,55.27,'Asia/Dubai'),
+    'dublin':(53.35,-6.26,'Europe/Dublin'),
+    'helsinki':(60.17,24.94,'Europe/Helsinki'),
+    'hong kong':(22.32,114.17,'Asia/Hong_Kong'),
+    'houston':(29.76,-95.37,'America/Chicago'),
+    'istanbul':(41.01,28.98,'Europe/Istanbul'),
+    'jakarta':(-6.21,106.85,'Asia/Jakarta'),
+    'johannesburg':(-26.20,28.05,'Africa/Johannesburg'),
+    'lagos':(6.52,3.38,'Africa/Lagos'),
+    'lima':(-12.05,-77.04,'America/Lima'),
+    'lisbon':(38.72,-9.14,'Europe/Lisbon'),
+    'london':(51.51,-0.13,'Europe/London'),
+    'los angeles':(34.05,-118.24,'America/Los_Angeles'),
+    'madrid':(40.42,-3.70,'Europe/Madrid'),
+    'manila':(14.60,120.98,'Asia/Manila'),
+    'melbourne':(-37.81,144.96,'Australia/Melbourne'),
+    'mexico city':(19.43,-99.13,'America/Mexico_City'),
+    'miami':(25.76,-80.19,'America/New_York'),
+    'milan':(45.46,9.19,'Europe/Rome'),
+    'montreal':(45.50,-73.57,'America/Toronto'),
+    'moscow':(55.76,37.62,'Europe/Moscow'),
+    'mumbai':(19.08,72.88,'Asia/Kolkata'),
+    'munich':(48.14,11.58,'Europe/Berlin'),
+    'nairobi':(-1.29,36.82,'Africa/Nairobi'),
+    'new york':(40.71,-74.01,'America/New_York'),
+    'oslo':(59.91,10.75,'Europe/Oslo'),
+    'paris':(48.86,2.35,'Europe/Paris'),
+    'philadelphia':(39.95,-75.17,'America/New_York'),
+    'phoenix':(33.45,-112.07,'America/Phoenix'),
+    'prague':(50.08,14.44,'Europe/Prague'),
+    'rio de janeiro':(-22.91,-43.17,'America/Sao_Paulo'),
+    'rome':(41.90,12.50,'Europe/Rome'),
+    'san francisco':(37.77,-122.42,'America/Los_Angeles'),
+    'santiago':(-33.45,-70.67,'America/Santiago'),
+    'sao paulo':(-23.55,-46.63,'America/Sao_Paulo'),
+    'seattle':(47.61,-122.33,'America/Los_Angeles'),
+    'seoul':(37.57,126.98,'Asia/Seoul'),
+    'shanghai':(31.23,121.47,'Asia/Shanghai'),
+    'singapore':(1.35,103.82,'Asia/Singapore'),
+    'stockholm':(59.33,18.07,'Europe/Stockholm'),
+    'sydney':(-33.87,151.21,'Australia/Sydney'),
+    'taipei':(25.03,121.57,'Asia/Taipei'),
+    'tokyo':(35.68,139.69,'Asia/Tokyo'),
+    'toronto':(43.65,-79.38,'America/Toronto'),
+    'vancouver':(49.28,-123.12,'America/Vancouver'),
+    'vienna':(48.21,16.37,'Europe/Vienna'),
+    'warsaw':(52.23,21.01,'Europe/Warsaw'),
+    'zurich':(47.38,8.54,'Europe/Zurich'),
+}
+
+def get_place(place):
+    # a gazetteer name, optionally followed by a country after a comma, or a latitude,longitude pair
+    name=place.split(',')[0].strip().lower()
+    if name in gazetteer:
+        return gazetteer[name]
+    try:
+        latitude, longitude = (float(value) for value in place.split(','))
+    except ValueError:
+        return None
+    if not (-90<=latitude<=90 and -180<=longitude<=180):
+        return None
+    return latitude, longitude, None
+
+def get_birth_date(local_date, longitude, time_zone):
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        if time_zone!=None:
+            return local_date.replace(tzinfo=ZoneInfo(time_zone)).astimezone(timezone.utc)
+    except ZoneInfoNotFoundError:
+        # windows has no time zone database unless tzdata is installed
+        pass
+    # mean solar time, within an hour or so of the civil time there
+    return (local_date-timedelta(hours=longitude/15)).replace(tzinfo=timezone.utc)
+
+def get_natal_longitudes(birth_date):
+    julian_day=get_julian_day(birth_date)
+    return {name:get_body_position(julian_day, name)[0] for name in get_body_names()}
+
+def get_natal_aspects(natal, date=None, minor=False):
+    # the sky comes from the cached positions, so each request only compares angles
+    lookup=get_aspect_lookup(minor)
+    aspects={}
+    for name_a, position in zip(get_body_names(), get_positions_raw(date)):
+        for name_b, natal_angle in natal.items():
+            separation=abs(get_angle_diff(position.angle, natal_angle))
+            for aspect_name, aspect_min, aspect_max in lookup[int(separation)]:
+                if aspect_min<separation<aspect_max:
+                    aspects.setdefault(name_a,{}).setdefault(aspect_name,[]).append(name_b)
+    return aspects
+
+def get_natal_aspects_formatted(user_id, date=None, minor=False, locale=default_locale):
+    profile=load_profile(user_id)
+    if profile==None:
+        return None
+    templates=get_templates(locale)
+    names=templates['names']
+    lines=[]
+
+    for planet,aspects in get_natal_aspects(profile['longitudes'],date,minor).items():
+        aspects={
+            names.get(aspect_name,aspect_name):[names.get(name,name) for name in aspect_planets]
+            for aspect_name, aspect_planets in aspects.items()
+        }
+        lines.append(templates['aspects'](body=names.get(planet,planet),aspects=get_aspect_list_rendered(templates,aspects,'natal_aspect')))
+
+    return ''.join(line+'\n' for line in lines)
+
+# Profile store
+
+# viewers' birth details and natal longitudes by twitch user id, computed once at registration
+profile_store=None
+profile_store_lock=Lock()
+
+def get_profile_store():
+    import sqlite3
+    global profile_store
+    if profile_store==None:
+        profile_store=sqlite3.connect(script_path()+'profiles.sqlite3',check_same_thread=False)
+        profile_store.execute('PRAGMA journal_mode=WAL')
+        profile_store.execute('CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, user_name TEXT NOT NULL, birth TEXT NOT NULL, place TEXT NOT NULL, longitudes TEXT NOT NULL)')
+    return profile_store
+
+def save_profile(user_id, user_name, local_date, place):
+    found=get_place(place)
+    if found==None:
+        return None
+    latitude, longitude, time_zone = found
+    birth_date=get_birth_date(local_date, longitude, time_zone)
+    profile={
+        'user_name':user_name,
+        'birth':birth_date,
+        'place':place,
+        'longitudes':get_natal_longitudes(birth_date),
     }
-    minor_aspects={
-        'semi-sextile':{'angle':30,'orb':1.5},
-        'inconjunct':{'angle':150,'orb':3},
-        'semi-square':{'angle':45,'orb':3},
-        'trioctile':{'angle':135,'orb':3},
-        'quintile':{'angle':72,'orb':1},
-        'biquintile':{'angle':144,'orb':1},
+    with profile_store_lock:
+        store=get_profile_store()
+        store.execute('INSERT OR REPLACE INTO profiles VALUES (?,?,?,?,?)',(
+            user_id,
+            user_name,
+            birth_date.isoformat(),
+            place,
+            json.dumps(profile['longitudes']),
+        ))
+        store.commit()
+    return profile
+
+def load_profile(user_id):
+    with profile_store_lock:
+        row=get_profile_store().execute('SELECT user_name, birth, place, longitudes FROM profiles WHERE user_id=?',(user_id,)).fetchone()
+    if row==None:
+        return None
+    return {
+        'user_name':row[0],
+        'birth':datetime.fromisoformat(row[1]),
+        'place':row[2],
+        'longitudes':json.loads(row[3]),
     }
-    aspects={}
-    if minor:
-        selected_aspects=minor_aspects
-    else:
-        selected_aspects=major_aspects
 
-    for aname, aposition in positions.copy().items():
-        del positions[aname]
-        if aname.endswith('Node'):
-            continue
-        planet_aspects={}
-        for bname, bposition in positions.items():
-            angle_diff=abs(aposition['angle']-bposition['angle'])
-            for aspect_name,aspect in selected_aspects.items():
-                aspect_max=(aspect['angle']+aspect['orb'])%360
-                aspect_min=(aspect['angle']-aspect['orb'])%360
-                if aspect_min<angle_diff<aspect_max:
-                    try:
-                        planet_aspects[aspect_name].append(bname)
-                    except KeyError:
-                        planet_aspects[aspect_name]=[bname]
-        if len(planet_aspects)!=0:
-            aspects[aname]=planet_aspects
+def delete_profile(user_id):
+    with profile_store_lock:
+        store=get_profile_store()
+        deleted=store.execute('DELETE FROM profiles WHERE user_id=?',(user_id,)).rowcount
+        store.commit()
+    return deleted!=0
 
-    return aspects
+# Worker functions
 
-@cache
-def get_aspects_formatted(date=today(),minor=False):
-    aspects_formatted=''
+# astrology functions run here instead of on the twitch event loop, either in threads
+# or, when run standalone with worker_pool = "process" in config.toml, in processes
+worker_pool=None
+# futures of computations that haven't finished yet, so identical requests share one
+worker_inflight={}
 
-    for planet,aspects in get_aspects(date,minor).items():
-        aspects_formatted+=planet+' is in '
-        aspects_list=[]
-        for aspect_name,aspect_planets in aspects.items():
-            aspects_list.append(aspect_name+' with '+get_list_formatted(aspect_planets))
-        aspects_formatted+=get_list_formatted(aspects_list)+'\n'
+def worker_setup(script_directory):
+    global script_path
+    def script_path():
+        return script_directory
+    dependency_setup()
 
-    return aspects_formatted
+def get_worker_pool():
+    global worker_pool
+    if worker_pool==None:
+        if load_settings().get('worker_pool','thread')=='process':
+            from concurrent.futures import ProcessPoolExecutor
+            worker_pool=ProcessPoolExecutor(initializer=worker_setup,initargs=(script_path(),))
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            worker_pool=ThreadPoolExecutor(thread_name_prefix='astrolobot',initializer=setup_swisseph_thread)
+    return worker_pool
+
+def reset_worker_pool():
+    global worker_pool
+    from concurrent.futures import ProcessPoolExecutor
+    # worker processes keep their own cached settings, bodies, templates and results,
+    # so they're replaced when those change, threads share the caches cleared here
+    pool=worker_pool
+    if not isinstance(pool,ProcessPoolExecutor):
+        return
+    worker_pool=None
+    # work already queued finishes on the old processes before they exit
+    pool.shutdown(wait=False)
+
+async def compute(function, *args, **kwargs):
+    import asyncio
+    from functools import partial
+    if not ephemeris_ready.is_set():
+        await asyncio.to_thread(ephemeris_ready.wait)
+    key=(function.__name__,args,tuple(sorted(kwargs.items())))
+    future=worker_inflight.get(key)
+    if future==None:
+        future=asyncio.get_running_loop().run_in_executor(get_worker_pool(),partial(function,*args,**kwargs))
+        worker_inflight[key]=future
+        def done(future):
+            if worker_inflight.get(key) is future:
+                del worker_inflight[key]
+        future.add_done_callback(done)
+    # shielded so one cancelled request doesn't cancel the computation for everyone waiting on it
+    return await asyncio.shield(future)
+
+# Command functions
+
+# setting name in config.toml or OBS, and the function and arguments that answer it
+command_handlers={
+    'positions':(get_positions_formatted,{}),
+    'transits':(get_transits_formatted,{}),
+    'major_aspects':(get_aspects_formatted,{}),
+    'minor_aspects':(get_aspects_formatted,{'minor':True}),
+    'major_aspect_transits':(get_aspect_transits_formatted,{}),
+    'minor_aspect_transits':(get_aspect_transits_formatted,{'minor':True}),
+}
+# setting name of the command that takes arguments after its text, see handle_natal_command
+natal_command='natal'
+# chat text to handler and the first characters of those texts for each channel,
+# rebuilt when config.toml changes or OBS calls script_update
+command_registries={}
+commands_mtime=None
+commands_checked=0
+commands_check_interval=2
+
+def get_settings_mtime():
+    try:
+        return path.getmtime(script_path()+'config.toml')
+    except OSError:
+        return None
+
+def get_channel_settings(channel=None):
+    settings=load_settings()
+    if channel!=None:
+        settings=settings|settings.get('channels',{}).get(channel,{})
+    return settings
 
-@cache
-def get_aspect_transits(date=today(),minor=False,maxdays=28):
-    date_now=today()
-    timestamp_now=date_now.timestamp()
-    aspects_now=get_aspects(date_now,minor)
-    pre_transits={}
-    days=0
-
-    def aspects_contains(aspects,planet_a,aspect=None,planet_b=None):
-        if planet_a not in aspects:
-            return False
-        elif aspect and aspect not in aspects[planet_a]:
-            return False
-        elif aspect and planet_b and planet_b not in aspects[planet_a][aspect]:
-            return False
-        return True
-
-    def ensure_pre_path(planet_a,aspect=None):
-        if planet_a not in pre_transits:
-            pre_transits[planet_a]={}
-        if aspect and aspect not in pre_transits[planet_a]:
-            pre_transits[planet_a][aspect]={}
-
-    def pre_planet_b(planet_a,aspect,planet_b,date_future,direction):
-        ensure_pre_path(planet_a,aspect)
-        pre_transits[planet_a][aspect][planet_b]={
-            'date':date_future,
-            'direction':direction
+def get_commands(channel=None):
+    global commands_mtime, commands_checked
+    now=time.monotonic()
+    if now-commands_checked>=commands_check_interval:
+        commands_checked=now
+        mtime=get_settings_mtime()
+        if mtime!=commands_mtime:
+            command_registries.clear()
+            if commands_mtime!=None:
+                Thread(target=setup_bodies,daemon=True).start()
+            clear_templates()
+            commands_mtime=mtime
+    registry=command_registries.get(channel)
+    if registry==None:
+        config=get_channel_settings(channel)
+        locale=config.get('locale',default_locale)
+        commands={
+            config[name]:(function,kwargs|{'locale':locale})
+            for name, (function, kwargs) in command_handlers.items()
+            if config.get(name)
+        }
+        natal=config.get(natal_command)
+        registry={
+            'commands':commands,
+            'names':{config[name]:name for name in command_handlers if config.get(name)},
+            'natal':natal,
+            'locale':locale,
+            'prefixes':frozenset(trigger[0] for trigger in commands)|frozenset(natal[:1] if natal else ''),
         }
+        command_registries[channel]=registry
+    return registry
+
+async def handle_chat_message(sender, data, channel=None):
+    text=data['message']['text']
+    registry=get_commands(channel)
+    # almost no chat messages are commands, so reject them on their first character
+    if text[:1] not in registry['prefixes']:
+        return
+    start=time.perf_counter()
+    handler=registry['commands'].get(text)
+    if handler==None:
+        natal=registry['natal']
+        if natal and (text==natal or text.startswith(natal+' ')):
+            sender.send(await handle_natal_command(natal,text[len(natal):].split(),data,registry['locale']),data['message_id'])
+            observe('astrolobot_command_seconds',time.perf_counter()-start,command=natal_command)
+        return
+    function, kwargs = handler
+    sender.send(await compute(function,**kwargs),data['message_id'])
+    observe('astrolobot_command_seconds',time.perf_counter()-start,command=registry['names'][text])
+
+def parse_birth(arguments):
+    # YYYY-MM-DD, then an optional HH:MM that defaults to noon, then the place
+    try:
+        local_date=datetime.strptime(arguments[0],'%Y-%m-%d').replace(hour=12)
+        if len(arguments)>1 and ':' in arguments[1]:
+            birth_time=datetime.strptime(arguments[1],'%H:%M')
+            local_date=local_date.replace(hour=birth_time.hour,minute=birth_time.minute)
+            arguments=arguments[1:]
+    except (IndexError, ValueError):
+        return None
+    if len(arguments)<2 or not natal_years[0]<=local_date.year<=natal_years[1]:
+        return None
+    return local_date, ' '.join(arguments[1:])
+
+async def handle_natal_command(command, arguments, data, locale=default_locale):
+    import asyncio
+    import swisseph as swe
+    templates=get_templates(locale)
+    user_id=data['chatter_user_id']
+    user_name=data['chatter_user_name']
+    usage=templates['natal_usage'](command=command)
+    if arguments[:1]==['set']:
+        birth=parse_birth(arguments[1:])
+        if birth==None:
+            return usage
+        try:
+            profile=await compute(save_profile,user_id,user_name,*birth)
+        except (swe.Error, OverflowError):
+            # the edges of natal_years can still fall outside the ephemeris in UTC
+            return templates['natal_unsupported_date'](first=natal_years[0],last=natal_years[1])
+        if profile==None:
+            return templates['natal_unknown_place'](place=repr(birth[1]))
+        return templates['natal_saved'](user=user_name,birth=profile['birth'].strftime('%Y-%m-%d %H:%M UTC'))
+    if arguments[:1]==['delete']:
+        deleted=await asyncio.to_thread(delete_profile,user_id)
+        return templates['natal_deleted' if deleted else 'natal_missing'](user=user_name)
+    if arguments not in ([],['minor']):
+        return usage
+    aspects=await compute(get_natal_aspects_formatted,user_id,minor=arguments==['minor'],locale=locale)
+    if aspects==None:
+        return usage
+    return aspects or templates['natal_nothing'](user=user_name)
+
+# how far ahead announcements are solved each time the heap is refilled, in days
+announcement_lookahead=1
+# events found this late are dropped instead of announced, in seconds
+announcement_grace=60
+# seconds before an announcer that failed starts again
+announcement_retry=60
+# announcer tasks by channel, so ready firing again after a reconnect doesn't start another
+announcers={}
+
+def get_julian_day_now():
+    return 2440587.5+time.time()/seconds_in_1_day
+
+def get_announcement(event, templates):
+    names=templates['body_names']
+    if isinstance(event,BodyEvent):
+        if event.kind=='zodiac':
+            return templates['announce_zodiac'](body=names[event.body],zodiac=templates['names'].get(event.value,event.value))
+        return templates['announce_retrograde' if event.value else 'announce_direct'](body=names[event.body])
+    if event.direction!='exact':
+        return None
+    return templates['announce_exact'](body_a=names[event.body_a],aspect=templates['aspect_names'][event.aspect],body_b=names[event.body_b])
+
+def get_announcements(start, end, minor=False, locale=default_locale):
+    templates=get_templates(locale)
+    announcements=[]
+    sources=[get_body_timeline_events(start, end),get_pair_timeline_events(False, start, end)]
+    if minor:
+        sources.append(get_pair_timeline_events(True, start, end))
+    for events in sources:
+        for event in events:
+            announcement=get_announcement(event,templates)
+            if announcement!=None:
+                announcements.append((event.julian_day,announcement))
+    return announcements
+
+def start_announcer(sender, channel=None):
+    import asyncio
+    task=announcers.get(channel)
+    if task==None or task.done():
+        announcers[channel]=asyncio.create_task(run_announcer(sender, channel))
 
-    def pre_aspect(planet_a,aspect,planets,date_future,direction):
-        ensure_pre_path(planet_a)
-        pre_transits[planet_a][aspect]={}
-        for planet_b in planets:
-            pre_planet_b(planet_a,aspect,planet_b,date_future,direction)
-
-    def pre_planet_a(planet_a,aspects,date_future,direction):
-        pre_transits[planet_a]={}
-        for aspect,planets in aspects.items():
-            pre_aspect(planet_a,aspect,planets,date_future,direction)
-
-    while days<maxdays:
-        days+=1
-        timestamp_future=timestamp_now+(seconds_in_1_day*days)
-        date_future=datetime.fromtimestamp(timestamp_future,timezone.utc)
-        aspects_future=get_aspects(date_future)
-        for planet_a,aspects in aspects_now.items():
-            try:
-                pre_transits[planet_a]
-            except KeyError:
-                if not aspects_contains(aspects_future,planet_a):
-                    pre_planet_a(planet_a,aspects,date_future,'exiting')
-                    continue
-            for aspect, planets in aspects.items():
-                try:
-                    pre_transits[planet_a][aspect]
-                except KeyError:
-                    if not aspects_contains(aspects_future,planet_a,aspect):
-                        pre_aspect(planet_a,aspect,planets,date_future,'exiting')
-                        continue
-                    for planet_b in planets:
-                        try:
-                            pre_transits[planet_a][aspect][planet_b]
-                        except KeyError:
-                            if not aspects_contains(aspects_future,planet_a,aspect,planet_b):
-                                pre_planet_b(planet_a,aspect,planet_b,date_future,'exiting')
-    
-    days=0
-    while days<maxdays:
-        days+=1
-        timestamp_future=timestamp_now+(seconds_in_1_day*days)
-        date_future=datetime.fromtimestamp(timestamp_future,timezone.utc)
-        aspects_future=get_aspects(date_future)
-        for planet_a,aspects in aspects_future.items():
-            try:
-                pre_transits[planet_a]
-            except KeyError:
-                if not aspects_contains(aspects_now,planet_a):
-                    pre_planet_a(planet_a,aspects,date_future,'entering')
+async def run_announcer(sender, channel=None):
+    import asyncio
+    # an announcer that fails is logged and started again, instead of silently stopping
+    while True:
+        try:
+            await announce(sender, channel)
+        except Exception as error:
+            print('announcing failed: '+repr(error)+', retrying in '+str(announcement_retry)+'s',file=sys.stderr)
+            await asyncio.sleep(announcement_retry)
+
+async def announce(sender, channel=None):
+    import asyncio, heapq
+    if not ephemeris_ready.is_set():
+        await asyncio.to_thread(ephemeris_ready.wait)
+    settings=get_channel_settings(channel)
+    minor=settings.get('announce_minor_aspects',False)
+    locale=settings.get('locale',default_locale)
+    heap=[]
+    end=get_julian_day_now()
+    while True:
+        now=get_julian_day_now()
+        # solve the next stretch of events once the heap runs into the end of the last one
+        if now>=end-announcement_lookahead/2:
+            loop=asyncio.get_running_loop()
+            announcements=await loop.run_in_executor(get_worker_pool(),get_announcements,end,now+announcement_lookahead,minor,locale)
+            for announcement in announcements:
+                heapq.heappush(heap,announcement)
+            end=now+announcement_lookahead
+        while len(heap)!=0 and heap[0][0]<=now:
+            julian_day, announcement = heapq.heappop(heap)
+            if (now-julian_day)*seconds_in_1_day<=announcement_grace:
+                sender.send(announcement)
+        wakeup=end-announcement_lookahead/2
+        if len(heap)!=0:
+            wakeup=min(wakeup,heap[0][0])
+        await asyncio.sleep(max(wakeup-get_julian_day_now(),0)*seconds_in_1_day)
+
+# Metrics functions
+
+# histograms of hot path timings as bucket counts, sum and count per label set,
+# rendered in the prometheus text format by get_metrics_text
+metrics_lock=Lock()
+metrics_histograms={}
+metrics_buckets=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30)
+# calc_ut takes microseconds, so it needs finer buckets than everything else
+metrics_buckets_by_name={
+    'astrolobot_calc_ut_seconds':(0.000005,0.00001,0.000025,0.00005,0.0001,0.00025,0.0005,0.001,0.01),
+}
+metrics_help={
+    'astrolobot_command_seconds':'time from a chat command to its reply being queued',
+    'astrolobot_calc_ut_seconds':'time spent in each swisseph calc_ut call',
+    'astrolobot_send_queue_seconds':'time replies wait in the chat send queue',
+    'astrolobot_event_loop_lag_seconds':'how late event loop timers fire',
+}
+# how often the event loop is checked for lag, in seconds
+event_loop_lag_interval=0.5
+
+def observe(name, value, **labels):
+    from bisect import bisect_left
+    key=tuple(sorted(labels.items()))
+    buckets=metrics_buckets_by_name.get(name,metrics_buckets)
+    with metrics_lock:
+        histogram=metrics_histograms.setdefault(name,{}).get(key)
+        if histogram==None:
+            histogram={'buckets':[0]*(len(buckets)+1),'sum':0.0,'count':0}
+            metrics_histograms[name][key]=histogram
+        histogram['buckets'][bisect_left(buckets,value)]+=1
+        histogram['sum']+=value
+        histogram['count']+=1
+
+async def monitor_event_loop():
+    import asyncio
+    while True:
+        before=time.monotonic()
+        await asyncio.sleep(event_loop_lag_interval)
+        observe('astrolobot_event_loop_lag_seconds',max(time.monotonic()-before-event_loop_lag_interval,0))
+
+def get_metric_labels(labels):
+    if len(labels)==0:
+        return ''
+    escaped=[]
+    for name, value in labels:
+        value=str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+        escaped.append(name+'="'+value+'"')
+    return '{'+','.join(escaped)+'}'
+
+def get_metrics_text():
+    with metrics_lock:
+        histograms={
+            name:{key:{'buckets':list(histogram['buckets']),'sum':histogram['sum'],'count':histogram['count']} for key, histogram in series.items()}
+            for name, series in metrics_histograms.items()
+        }
+    lines=[]
+
+    for name, series in histograms.items():
+        buckets=metrics_buckets_by_name.get(name,metrics_buckets)
+        lines.append('# HELP '+name+' '+metrics_help.get(name,name))
+        lines.append('# TYPE '+name+' histogram')
+        for key, histogram in series.items():
+            total=0
+            for bound, count in zip(buckets+('+Inf',),histogram['buckets']):
+                total+=count
+                lines.append(name+'_bucket'+get_metric_labels(key+(('le',bound),))+' '+str(total))
+            lines.append(name+'_sum'+get_metric_labels(key)+' '+repr(histogram['sum']))
+            lines.append(name+'_count'+get_metric_labels(key)+' '+str(histogram['count']))
+
+    cache_stats=get_cache_stats()
+    lines.append('# HELP astrolobot_cache_requests_total result cache lookups by function and outcome')
+    lines.append('# TYPE astrolobot_cache_requests_total counter')
+    for function, stats in cache_stats['functions'].items():
+        for result in ('hits','misses','store_hits'):
+            lines.append('astrolobot_cache_requests_total'+get_metric_labels((('function',function),('result',result)))+' '+str(stats[result]))
+    lines.append('# HELP astrolobot_cache_entries results held in the result cache')
+    lines.append('# TYPE astrolobot_cache_entries gauge')
+    lines.append('astrolobot_cache_entries '+str(cache_stats['size']))
+
+    sender_metrics={
+        'sent':('counter','astrolobot_chat_messages_sent_total','chat messages sent'),
+        'deduplicated':('counter','astrolobot_chat_messages_deduplicated_total','replies dropped as duplicates of pending ones'),
+        'failed':('counter','astrolobot_chat_messages_failed_total','chat messages twitch refused'),
+        'queue_depth':('gauge','astrolobot_chat_queue_depth','replies waiting for the chat rate limit'),
+    }
+    sender_stats={channel:sender.get_stats() for channel, sender in list(chat_senders.items())}
+    for stat, (kind, name, description) in sender_metrics.items():
+        lines.append('# HELP '+name+' '+description)
+        lines.append('# TYPE '+name+' '+kind)
+        for channel, stats in sender_stats.items():
+            lines.append(name+get_metric_labels((('channel',channel or ''),))+' '+str(stats[stat]))
+
+    return '\n'.join(lines)+'\n'
+
+async def handle_metrics_request(request):
+    from aiohttp import web
+    return web.Response(text=get_metrics_text(),content_type='text/plain',charset='utf-8',headers={'Cache-Control':'no-cache'})
+
+# one profile at a time, since samples from two would count every stack twice
+profile_lock=Lock()
+
+def sample_profile(seconds=10, interval=0.005):
+    # samples every other thread's stack and writes them in the collapsed format
+    # flamegraph tools read, one line per distinct stack with how often it was seen
+    import threading
+    if not profile_lock.acquire(blocking=False):
+        print('a profile is already running',file=sys.stderr)
+        return None
+    try:
+        print('profiling for '+str(seconds)+' seconds')
+        stacks={}
+        samples=0
+        current=threading.get_ident()
+        end=time.monotonic()+seconds
+        while time.monotonic()<end:
+            names={thread.ident:thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id==current:
                     continue
-            for aspect, planets in aspects.items():
-                try:
-                    pre_transits[planet_a][aspect]
-                except KeyError:
-                    if not aspects_contains(aspects_now,planet_a,aspect):
-                        pre_aspect(planet_a,aspect,planets,date_future,'entering')
-                        continue
-                    for planet_b in planets:
-                        try:
-                            pre_transits[planet_a][aspect][planet_b]
-                        except KeyError:
-                            if not aspects_contains(aspects_now,planet_a,aspect,planet_b):
-                                pre_planet_b(planet_a,aspect,planet_b,date_future,'entering')
-
-    post_transits={}
-
-    for planet_a,aspects in pre_transits.items():
-        post_transits[planet_a]={}
-        for aspect,planets in aspects.items():
-            for planet_b,transit in planets.items():
-                direction=transit['direction']
-                date=transit['date']
-                if direction not in post_transits[planet_a]:
-                    post_transits[planet_a][direction]={}
-                if date not in post_transits[planet_a][direction]:
-                    post_transits[planet_a][direction][date]={}
-                if aspect not in post_transits[planet_a][direction][date]:
-                    post_transits[planet_a][direction][date][aspect]=[]
-                post_transits[planet_a][direction][date][aspect].append(planet_b)
-
-    return post_transits
-
-@cache
-def get_aspect_transits_formatted(date=today(),minor=False,maxdays=28):
-    aspect_transits=get_aspect_transits(date,minor,maxdays)
-    aspect_transits_formatted=''
+                stack=[]
+                while frame!=None:
+                    stack.append(frame.f_code.co_name+' ('+path.basename(frame.f_code.co_filename)+':'+str(frame.f_code.co_firstlineno)+')')
+                    frame=frame.f_back
+                stack.append(names.get(thread_id,str(thread_id)))
+                key=';'.join(reversed(stack))
+                stacks[key]=stacks.get(key,0)+1
+            samples+=1
+            time.sleep(interval)
+        profile_path=script_path()+'profile-'+datetime.now().strftime('%Y%m%d-%H%M%S')+'.txt'
+        with open(profile_path,'w') as file:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                file.write(stack+' '+str(count)+'\n')
+        print(str(samples)+' profile samples saved to '+profile_path)
+        return profile_path
+    finally:
+        profile_lock.release()
+
+# HTTP functions
+
+# JSON for overlays, at the path after the slash, answered by the same cached functions as chat
+api_handlers={
+    'positions':(get_positions,{}),
+    'transits':(get_transits,{}),
+    'aspects/major':(get_aspects,{}),
+    'aspects/minor':(get_aspects,{'minor':True}),
+    'aspect_transits/major':(get_aspect_transits,{}),
+    'aspect_transits/minor':(get_aspect_transits,{'minor':True}),
+}
+# response bodies by ETag for the current result quantum, so polling doesn't serialize again
+api_responses={}
+api_responses_date=None
+# seconds between SSE comments that keep idle connections open through proxies
+api_keepalive=15
+# tasks serving SSE streams, which never finish on their own, so shutdown cancels them
+api_event_streams=set()
+
+def get_api_date():
+    return quantize_date(datetime.utcnow(),result_resolution)
+
+def get_api_etag(name, date):
+    import hashlib
+    # results only change with the quantum and the store version, so the ETag is known
+    # before anything is computed and a 304 costs no computation at all
+    etag=hashlib.sha256((name+'|'+date.isoformat()+'|'+get_store_version()).encode()).hexdigest()[:16]
+    return '"'+etag+'"'
+
+def get_api_json(value):
+    if isinstance(value,datetime):
+        return value.isoformat()
+    raise TypeError(type(value).__name__+' is not JSON serializable')
+
+async def get_api_response(name, date):
+    global api_responses_date
+    etag=get_api_etag(name, date)
+    if api_responses_date!=date:
+        api_responses.clear()
+        api_responses_date=date
+    if etag not in api_responses:
+        function, kwargs = api_handlers[name]
+        records=await compute(function,date=date,**kwargs)
+        api_responses[etag]=json.dumps([get_record_dict(record) for record in records],default=get_api_json)
+    return etag, api_responses[etag]
+
+def get_api_headers(etag, date):
+    from email.utils import format_datetime
+    # results can't change before the next quantum, so browsers needn't ask until then
+    expires=date+timedelta(seconds=result_resolution)-datetime.utcnow()
+    return {
+        'ETag':etag,
+        'Last-Modified':format_datetime(date.replace(tzinfo=timezone.utc),usegmt=True),
+        'Cache-Control':'max-age='+str(max(int(expires.total_seconds()),0)),
+        'Access-Control-Allow-Origin':'*',
+    }
 
-    for planet_a,directions in aspect_transits.items():
-        aspect_transits_formatted+=planet_a+' is '
-        direction_list=[]
-        for direction,dates in directions.items():
-            date_list=[]
-            for date,aspects in dates.items():
-                aspect_list=[]
-                for aspect,planets in aspects.items():
-                    aspect_list.append(aspect+' with '+get_list_formatted(planets))
-                date_list.append(get_list_formatted(aspect_list)+' on '+date.strftime(date_format))
-            direction_list.append(direction+' '+get_list_formatted(date_list))
-        aspect_transits_formatted+=get_list_formatted(direction_list)+'\n'
-    
-    return aspect_transits_formatted
+def is_not_modified(request, etag, date):
+    from email.utils import parsedate_to_datetime
+    if 'If-None-Match' in request.headers:
+        tags=[tag.strip() for tag in request.headers['If-None-Match'].split(',')]
+        return etag in tags or '*' in tags
+    if 'If-Modified-Since' in request.headers:
+        try:
+            since=parsedate_to_datetime(request.headers['If-Modified-Since'])
+        except (TypeError, ValueError):
+            return False
+        return since.astimezone(timezone.utc).replace(tzinfo=None)>=date
+    return False
+
+async def handle_api_request(request):
+    from aiohttp import web
+    name=request.match_info['name']
+    if name not in api_handlers:
+        raise web.HTTPNotFound(text=json.dumps({'error':'unknown endpoint','endpoints':list(api_handlers)}),content_type='application/json')
+    date=get_api_date()
+    etag=get_api_etag(name, date)
+    headers=get_api_headers(etag, date)
+    if is_not_modified(request, etag, date):
+        return web.Response(status=304,headers=headers)
+    etag, body = await get_api_response(name, date)
+    return web.Response(text=body,content_type='application/json',headers=headers)
+
+async def handle_api_events(request):
+    import asyncio
+    from aiohttp import web
+    response=web.StreamResponse(headers={
+        'Content-Type':'text/event-stream',
+        'Cache-Control':'no-cache',
+        'Access-Control-Allow-Origin':'*',
+    })
+    await response.prepare(request)
+    date=None
+    api_event_streams.add(asyncio.current_task())
+    try:
+        while True:
+            if get_api_date()!=date:
+                # every endpoint once on connect, then again whenever the results roll over
+                date=get_api_date()
+                for name in api_handlers:
+                    etag, body = await get_api_response(name, date)
+                    await response.write(('event: '+name+'\nid: '+etag+'\ndata: '+body+'\n\n').encode())
+            else:
+                await response.write(b': keepalive\n\n')
+            until_rollover=result_resolution-time.time()%result_resolution+1
+            await asyncio.sleep(min(until_rollover,api_keepalive))
+    except ConnectionResetError:
+        pass
+    finally:
+        api_event_streams.discard(asyncio.current_task())
+    return response
+
+async def close_api_events(app):
+    for task in list(api_event_streams):
+        task.cancel()
+
+async def start_http_server(host='127.0.0.1', port=8642):
+    from aiohttp import web
+    app=web.Application()
+    app.router.add_get('/events',handle_api_events)
+    app.on_shutdown.append(close_api_events)
+    app.router.add_get('/metrics',handle_metrics_request)
+    app.router.add_get('/{name:.+}',handle_api_request)
+    runner=web.AppRunner(app,handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner,host,port).start()
+    print('serving overlay data on http://'+host+':'+str(port)+'/')
+    return runner
 
 # Twitch functions
 
+client_id='h08yimv2stqxci85tpfh5k7t16an2u'
 device_code=None
 
+class ChatSender:
+    # queues replies for one chat and sends them no faster than twitch allows,
+    # packing lines into as few messages as fit and dropping duplicate pending replies,
+    # with get_chat looked up on every send since reconnects replace the chat object
+
+    def __init__(self, get_chat, rate=20, per=30, max_length=500, separator=' | '):
+        from collections import deque
+        self.get_chat=get_chat
+        self.rate=rate
+        self.per=per
+        self.max_length=max_length
+        self.separator=separator
+        self.queue=deque()
+        self.pending=set()
+        self.tokens=rate
+        self.updated=time.monotonic()
+        self.task=None
+        self.wakeup=None
+        self.stats={'sent':0,'deduplicated':0,'failed':0,'latency_total':0.0,'latency_max':0.0}
+
+    def pack(self, text):
+        messages=[]
+        message=''
+        for line in text.splitlines(False):
+            while len(line)>self.max_length:
+                split=line.rfind(' ',0,self.max_length)
+                if split<=0:
+                    split=self.max_length
+                messages.append(line[:split])
+                line=line[split:].lstrip()
+            if len(line)==0:
+                continue
+            if len(message)==0:
+                message=line
+            elif len(message)+len(self.separator)+len(line)<=self.max_length:
+                message+=self.separator+line
+            else:
+                messages.append(message)
+                message=line
+        if len(message)!=0:
+            messages.append(message)
+        return messages
+
+    def send(self, text, reply_message_id=None):
+        import asyncio
+        for message in self.pack(text):
+            if message in self.pending:
+                self.stats['deduplicated']+=1
+                continue
+            self.pending.add(message)
+            self.queue.append((message,reply_message_id,time.monotonic()))
+        if self.wakeup==None:
+            self.wakeup=asyncio.Event()
+        self.wakeup.set()
+        if self.task==None or self.task.done():
+            self.task=asyncio.get_running_loop().create_task(self.run())
+
+    async def acquire(self):
+        import asyncio
+        while True:
+            now=time.monotonic()
+            self.tokens=min(self.rate,self.tokens+(now-self.updated)*self.rate/self.per)
+            self.updated=now
+            if self.tokens>=1:
+                self.tokens-=1
+                return
+            await asyncio.sleep((1-self.tokens)*self.per/self.rate)
+
+    async def run(self):
+        while True:
+            if len(self.queue)==0:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.acquire()
+            message, reply_message_id, queued = self.queue.popleft()
+            self.pending.discard(message)
+            try:
+                await self.get_chat().send_message(message,reply_message_id)
+            except Exception as error:
+                self.stats['failed']+=1
+                print('sending chat message failed: '+repr(error),file=sys.stderr)
+                continue
+            latency=time.monotonic()-queued
+            observe('astrolobot_send_queue_seconds',latency)
+            self.stats['sent']+=1
+            self.stats['latency_total']+=latency
+            self.stats['latency_max']=max(self.stats['latency_max'],latency)
+
+    def get_stats(self):
+        stats=self.stats.copy()
+        stats['queue_depth']=len(self.queue)
+        stats['latency_average']=stats['latency_total']/max(stats['sent'],1)
+        return stats
+
 def login(*args):
     global device_code
     if device_code==None:
@@ -401,10 +2135,16 @@ def login(*args):
         login_url='https://www.twitch.tv/activate?public=true&device-code='+device_code
         print("if your browser doesn't automatically open, go to the following url:")
         print(login_url)
+        import webbrowser
         webbrowser.open(login_url)
 
-def save_tokens(access_token,refresh_token):
-    with open(script_path()+'tokens.json','w') as file:
+def get_tokens_path(channel=None):
+    if channel==None:
+        return script_path()+'tokens.json'
+    return script_path()+'tokens.'+channel+'.json'
+
+def save_tokens(access_token,refresh_token,channel=None):
+    with open(get_tokens_path(channel),'w') as file:
         json.dump(
             {
                 'access_token':access_token,
@@ -412,50 +2152,80 @@ def save_tokens(access_token,refresh_token):
             },
             file
         )
-    print('login tokens saved to '+script_path()+'tokens.json')
+    print('login tokens saved to '+get_tokens_path(channel))
 
-def load_tokens():
+def load_tokens(channel=None):
     try:
-        with open(script_path()+'tokens.json','r') as file:
+        with open(get_tokens_path(channel),'r') as file:
             return json.load(file)
     except FileNotFoundError:
         return {}
 
-def refresh_tokens(refresh_token):
+token_url='https://id.twitch.tv/oauth2/token'
+# reused for every token refresh so each one skips the TCP and TLS handshakes
+auth_session=None
+
+def get_auth_session():
+    import aiohttp
+    global auth_session
+    if auth_session==None or auth_session.closed:
+        auth_session=aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    return auth_session
+
+async def close_auth_session():
+    global auth_session
+    if auth_session!=None:
+        await auth_session.close()
+        auth_session=None
+
+def get_refresh_delay(expire_in):
+    import random
+    # refresh between 80% and 90% of the way to expiry so several channels don't refresh at once
+    return expire_in*(0.8+random.random()*0.1)
+
+async def refresh_tokens(refresh_token,channel=None,retries=5):
+    import asyncio, aiohttp, random
     print('refreshing login tokens')
-    global client
-    refresh_request=Request(
-        'https://id.twitch.tv/oauth2/token',
-        (
-            'client_id='+client.client_id
-            +'&grant_type=refresh_token'
-            +'&refresh_token='+refresh_token
-        ).encode(),
-        {'Content-Type':'application/x-www-form-urlencoded'}
-    )
-    try:
-        refresh_response=urlopen(refresh_request)
-        refresh_response=json.loads(refresh_response.read())
-        save_tokens(refresh_response['access_token'],refresh_response['refresh_token'])
-        return{
-            'access_token':refresh_response['access_token'],
-            'refresh_token':refresh_response['refresh_token'],
-        }
-    except HTTPError:
-        print('refreshing tokens failed')
-        return {}
-
-def main():
+    for attempt in range(retries):
+        try:
+            async with get_auth_session().post(token_url,data={
+                'client_id':client_id,
+                'grant_type':'refresh_token',
+                'refresh_token':refresh_token,
+            }) as refresh_response:
+                # the refresh token itself was rejected, so retrying won't help
+                if refresh_response.status in (400,401):
+                    break
+                refresh_response.raise_for_status()
+                refresh_response=await refresh_response.json()
+            await asyncio.to_thread(save_tokens,refresh_response['access_token'],refresh_response['refresh_token'],channel)
+            return{
+                'access_token':refresh_response['access_token'],
+                'refresh_token':refresh_response['refresh_token'],
+            }
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if attempt==retries-1:
+                print('refreshing tokens failed: '+str(error),file=sys.stderr)
+                break
+            delay=min(2**attempt,60)*(0.5+random.random())
+            print('refreshing tokens failed: '+str(error)+', retrying in '+format(delay,'.1f')+'s',file=sys.stderr)
+            await asyncio.sleep(delay)
+    print('refreshing tokens failed')
+    return {}
+
+# twitch clients and their chat senders by channel name from config.toml,
+# or None for the single channel mode
+clients={}
+chat_senders={}
+
+def setup_client(channel=None, client_class=None):
     from twitch import Client
     from twitch.types import eventsub
     from twitch.ext.oauth import DeviceAuthFlow, Scopes
     import asyncio
-    global client
-    client = Client(client_id='h08yimv2stqxci85tpfh5k7t16an2u')
-    tokens=load_tokens()
-    if len(tokens)!=0:
-        tokens=refresh_tokens(tokens['refresh_token'])
-    DeviceAuthFlow(
+    client = (client_class or Client)(client_id=client_id)
+    clients[channel]=client
+    flow=DeviceAuthFlow(
         client=client,
         scopes=[
             Scopes.CHANNEL_BOT,
@@ -463,77 +2233,117 @@ def main():
             Scopes.USER_READ_CHAT,
             Scopes.USER_WRITE_CHAT,
         ],
-        wrap_run=len(tokens)==0
+        wrap_run=False
     )
+    # one sender for the client's lifetime, so reconnects share its token bucket
+    config=get_channel_settings(channel)
+    sender=ChatSender(lambda: client.channel.chat,config.get('chat_rate_limit',20),config.get('chat_rate_window',30))
+    chat_senders[channel]=sender
 
     @client.event
     async def on_code(code: str):
-        global device_code, obs_settings
-        device_code=code
-        if len(tokens)==0:
+        global device_code
+        if channel==None:
+            device_code=code
             login()
+        else:
+            print('login for '+channel+': https://www.twitch.tv/activate?public=true&device-code='+code)
 
     @client.event
     async def on_auth(access_token: str, refresh_token: str):
-        save_tokens(access_token,refresh_token)
+        await asyncio.to_thread(save_tokens,access_token,refresh_token,channel)
 
     @client.event
     async def on_ready() -> None:
-        print('astrolobot ready')
+        config=get_channel_settings(channel)
+        if config.get('announcements',False):
+            start_announcer(sender,channel)
+        log_phase('astrolobot'+('' if channel==None else ' for '+channel),startup_time)
         while True:
             tokens=client.http.get_token(client.user.id)
-            await asyncio.sleep(tokens['expire_in']*0.9)
-            tokens=refresh_tokens(tokens['refresh_token'])
-            await client.authorize(tokens['access_token'],tokens['refresh_token'])
+            await asyncio.sleep(get_refresh_delay(tokens['expire_in']))
+            tokens=await refresh_tokens(tokens['refresh_token'],channel)
+            if len(tokens)!=0:
+                await client.authorize(tokens['access_token'],tokens['refresh_token'])
 
     @client.event
     async def on_chat_message(data: eventsub.chat.MessageEvent):
-        config=load_settings()
-        if data['message']['text']==config['positions']:
-            for line in get_positions_formatted().splitlines(False):
-                await client.channel.chat.send_message(line,data['message_id'])
-            return
-        if data['message']['text']==config['transits']:
-            for line in get_transits_formatted().splitlines(False):
-                await client.channel.chat.send_message(line,data['message_id'])
-            return
-        if data['message']['text']==config['major_aspects']:
-            for line in get_aspects_formatted().splitlines(False):
-                await client.channel.chat.send_message(line,data['message_id'])
-            return
-        if data['message']['text']==config['minor_aspects']:
-            for line in get_aspects_formatted(minor=True).splitlines(False):
-                await client.channel.chat.send_message(line,data['message_id'])
-            return
-        if data['message']['text']==config['major_aspect_transits']:
-            for line in get_aspect_transits_formatted().splitlines(False):
-                await client.channel.chat.send_message(line,data['message_id'])
-            return
-        if data['message']['text']==config['minor_aspect_transits']:
-            for line in get_aspect_transits_formatted(minor=True).splitlines(False):
-                await client.channel.chat.send_message(line,data['message_id'])
-            return
-
-    client.run(*tokens.values())
+        await handle_chat_message(sender,data,channel)
+
+    return client, flow
+
+async def run_client(channel=None):
+    client, flow = setup_client(channel)
+    import asyncio
+    tokens=await asyncio.to_thread(load_tokens,channel)
+    if len(tokens)!=0:
+        tokens=await refresh_tokens(tokens['refresh_token'],channel)
+    if len(tokens)==0:
+        async with flow:
+            user_code, device_code, expires_in, interval = await flow.get_device_code()
+            access_token, refresh_token = await flow.poll_for_authorization(device_code, expires_in, interval)
+        tokens={
+            'access_token':access_token,
+            'refresh_token':refresh_token,
+        }
+    async with client:
+        await client.start(tokens['access_token'],tokens['refresh_token'])
+
+def main():
+    from twitch.utils import setup_logging
+    import asyncio
+    Thread(target=prewarm_loop,daemon=True).start()
+    # every channel shares this process's ephemeris, caches and worker pool
+    settings=load_settings()
+    channels=list(settings.get('channels',{})) or [None]
+    setup_logging()
+
+    async def runner():
+        http_server=None
+        lag_monitor=asyncio.create_task(monitor_event_loop())
+        try:
+            if settings.get('http_server',False):
+                http_server=await start_http_server(settings.get('http_host','127.0.0.1'),settings.get('http_port',8642))
+            await asyncio.gather(*(run_client(channel) for channel in channels))
+        finally:
+            lag_monitor.cancel()
+            if http_server!=None:
+                await http_server.cleanup()
+            await close_auth_session()
+
+    try:
+        asyncio.run(runner())
+    except KeyboardInterrupt:
+        return
 
 # OBS functions
 
 obs_settings=None
 
 def script_main():
-    dependency_setup()
+    # twitch only needs pip, so it connects while the database downloads and swisseph loads
+    download=Thread(target=setup_ephemeris_file,daemon=True)
+    download.start()
+    setup_pip()
+    def setup_ephemeris():
+        download.join()
+        setup_swisseph()
+    Thread(target=setup_ephemeris,daemon=True).start()
     main()
 
 def obs_update(*args):
     Thread(target=update,daemon=True).start()
 
+def obs_profile(*args):
+    Thread(target=sample_profile,daemon=True).start()
+
 def obs_load_settings():
     import obspython
     global obs_settings
     settings=json.loads(obspython.obs_data_get_json_with_defaults(obs_settings))
     return settings
     
-def obs_load_tokens():
+def obs_load_tokens(channel=None):
     import obspython
     access_token=obspython.obs_data_get_string(obs_settings,'access_token')
     refresh_token=obspython.obs_data_get_string(obs_settings,'refresh_token')
@@ -546,7 +2356,7 @@ def obs_load_tokens():
             'refresh_token':refresh_token,
         }
 
-def obs_save_tokens(access_token,refresh_token):
+def obs_save_tokens(access_token,refresh_token,channel=None):
     import obspython
     obspython.obs_data_set_string(obs_settings,'access_token',access_token)
     obspython.obs_data_set_string(obs_settings,'refresh_token',refresh_token)
@@ -562,6 +2372,7 @@ def script_properties():
     properties=obspython.obs_properties_create()
     obspython.obs_properties_add_button(properties,'login','Login to Twitch',login)
     obspython.obs_properties_add_button(properties,'update','Check for Updates',obs_update)
+    obspython.obs_properties_add_button(properties,'profile','Profile for 10 Seconds',obs_profile)
     obspython.obs_properties_add_text(properties,'commands','commands',obspython.OBS_TEXT_INFO)
     obspython.obs_properties_add_text(properties,'positions','positions',obspython.OBS_TEXT_DEFAULT)
     obspython.obs_properties_add_text(properties,'transits','transits',obspython.OBS_TEXT_DEFAULT)
@@ -569,6 +2380,14 @@ def script_properties():
     obspython.obs_properties_add_text(properties,'minor_aspects','minor aspects',obspython.OBS_TEXT_DEFAULT)
     obspython.obs_properties_add_text(properties,'major_aspect_transits','major aspect transits',obspython.OBS_TEXT_DEFAULT)
     obspython.obs_properties_add_text(properties,'minor_aspect_transits','minor aspect transits',obspython.OBS_TEXT_DEFAULT)
+    obspython.obs_properties_add_text(properties,'natal','natal chart',obspython.OBS_TEXT_DEFAULT)
+    obspython.obs_properties_add_int(properties,'ephemeris_table_years','ephemeris table years',1,50,1)
+    obspython.obs_properties_add_text(properties,'bodies','extra bodies, comma separated ('+', '.join(optional_bodies)+')',obspython.OBS_TEXT_DEFAULT)
+    obspython.obs_properties_add_text(properties,'fixed_stars','fixed stars, comma separated',obspython.OBS_TEXT_DEFAULT)
+    obspython.obs_properties_add_bool(properties,'announcements','announce ingresses, stations and exact aspects in chat')
+    obspython.obs_properties_add_bool(properties,'announce_minor_aspects','announce exact minor aspects')
+    obspython.obs_properties_add_bool(properties,'http_server','serve overlay data over HTTP')
+    obspython.obs_properties_add_int(properties,'http_port','overlay HTTP port',1024,65535,1)
     return properties
 
 def script_defaults(settings):
@@ -580,6 +2399,15 @@ def script_defaults(settings):
     obspython.obs_data_set_default_string(settings,'minor_aspects','!aspects minor')
     obspython.obs_data_set_default_string(settings,'major_aspect_transits','!aspects major transits')
     obspython.obs_data_set_default_string(settings,'minor_aspect_transits','!aspects minor transits')
+    obspython.obs_data_set_default_string(settings,'natal','!natal')
+    obspython.obs_data_set_default_int(settings,'ephemeris_table_years',2)
+    obspython.obs_data_set_default_string(settings,'bodies','')
+    obspython.obs_data_set_default_string(settings,'fixed_stars','')
+    obspython.obs_data_set_default_bool(settings,'announcements',False)
+    obspython.obs_data_set_default_bool(settings,'announce_minor_aspects',False)
+    obspython.obs_data_set_default_bool(settings,'http_server',False)
+    obspython.obs_data_set_default_string(settings,'http_host','127.0.0.1')
+    obspython.obs_data_set_default_int(settings,'http_port',8642)
 
 def script_load(settings):
     global obs_settings, save_tokens, load_tokens, load_settings
@@ -595,25 +2423,470 @@ def script_load(settings):
 def script_unload():
     try:
         import asyncio
-        global client
-        asyncio.run(client.close())
+        for client in clients.values():
+            asyncio.run(client.close())
     except NameError or ImportError:
         pass
 
 def script_update(settings):
     global obs_settings
     obs_settings=settings
+    command_registries.clear()
+    clear_templates()
+    if ephemeris_ready.is_set():
+        Thread(target=setup_bodies,daemon=True).start()
+
+# Export functions
+
+# columns of every record kind, so csv rows line up whichever kinds are included
+export_fields=['type','date','body','angle','speed','zodiac','retrograde','planet_a','aspect','planet_b','direction']
+export_kinds=['positions','aspects','transits','aspect_transits']
+
+def export_setup(script_directory):
+    # setup messages would end up in the middle of an export written to stdout
+    sys.stdout=sys.stderr
+    worker_setup(script_directory)
+
+def get_export_date(julian_day):
+    return get_date(julian_day).isoformat(timespec='seconds')
+
+def export_chunk(start, samples, step, bodies, minor=False, kinds=export_kinds):
+    # one chunk of an export as a list of records sorted by time, starting at the start
+    # datetime and covering samples steps of step hours
+    first=get_julian_day(start)
+    last=first+samples*step/24
+    julian_days=[first+index*step/24 for index in range(samples)]
+    records=[]
+
+    if 'positions' in kinds or 'aspects' in kinds:
+        positions=[[get_body_position(julian_day, name) for julian_day in julian_days] for name in bodies]
+    if 'positions' in kinds:
+        for index, julian_day in enumerate(julian_days):
+            for name, body_positions in zip(bodies, positions):
+                angle, speed = body_positions[index]
+                records.append((julian_day, {
+                    'type':'position',
+                    'date':get_export_date(julian_day),
+                    'body':name,
+                    'angle':angle,
+                    'speed':speed,
+                    'zodiac':get_zodiac(angle),
+                    'retrograde':is_retrograde(speed),
+                }))
+    if 'aspects' in kinds:
+        longitudes=[[angle for angle, speed in body_positions] for body_positions in positions]
+        for julian_day, aspects in zip(julian_days, get_aspects_batch(bodies, longitudes, minor)):
+            for index_a, aspect, index_b in aspects:
+                records.append((julian_day, {
+                    'type':'aspect',
+                    'date':get_export_date(julian_day),
+                    'planet_a':bodies[index_a],
+                    'aspect':get_aspect_names()[aspect],
+                    'planet_b':bodies[index_b],
+                }))
+    if 'transits' in kinds:
+        for name in bodies:
+            for julian_day, kind, value in get_body_events(name, first, last):
+                transit={
+                    'type':'transit',
+                    'date':get_export_date(julian_day),
+                    'body':name,
+                    'zodiac':None,
+                    'retrograde':None,
+                }
+                transit[kind]=value
+                records.append((julian_day, transit))
+    if 'aspect_transits' in kinds:
+        for name_a, name_b in get_aspect_pairs(bodies):
+            for julian_day, aspect_name, direction in get_pair_events(name_a, name_b, get_aspect_table(minor), first, last):
+                records.append((julian_day, {
+                    'type':'aspect_transit',
+                    'date':get_export_date(julian_day),
+                    'planet_a':name_a,
+                    'aspect':aspect_name,
+                    'planet_b':name_b,
+                    'direction':direction,
+                }))
+
+    records.sort(key=lambda record: record[0])
+    return [record for julian_day, record in records]
+
+def get_export_chunks(start, days, step, chunk_days):
+    # chunks start on whole steps from the start so samples are spaced evenly across chunks
+    samples=int(days*24/step)
+    chunk_samples=max(int(chunk_days*24/step),1)
+    for index in range(0, samples, chunk_samples):
+        yield start+timedelta(hours=index*step), min(chunk_samples, samples-index)
+
+def export_records(start, days=365, step=24, bodies=None, minor=False, kinds=export_kinds, chunk_days=30, processes=None):
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    if bodies==None:
+        bodies=get_body_names()
+    chunks=get_export_chunks(start, days, step, chunk_days)
+    processes=processes or os.cpu_count() or 1
+    if processes==1:
+        for chunk_start, samples in chunks:
+            yield from export_chunk(chunk_start, samples, step, bodies, minor, kinds)
+        return
+    with ProcessPoolExecutor(processes,initializer=export_setup,initargs=(script_path(),)) as pool:
+        # only a few chunks per process are in flight, so memory doesn't grow with the range
+        pending=deque()
+        for chunk_start, samples in chunks:
+            pending.append(pool.submit(export_chunk, chunk_start, samples, step, bodies, minor, kinds))
+            if len(pending)>=2*processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def write_export(records, file, file_format='jsonl'):
+    import csv
+    count=0
+    if file_format=='csv':
+        writer=csv.DictWriter(file,export_fields,restval='',lineterminator='\n')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count+=1
+    else:
+        for record in records:
+            file.write(json.dumps(record)+'\n')
+            count+=1
+    return count
+
+def export(start=None, days=365, step=24, bodies=None, minor=False, kinds=export_kinds, output=None, file_format='jsonl', chunk_days=30, processes=None):
+    started=time.perf_counter()
+    if start==None:
+        start=today()
+    records=export_records(start, days, step, bodies, minor, kinds, chunk_days, processes)
+    if output==None:
+        count=write_export(records, sys.stdout, file_format)
+    else:
+        with open(output,'w',newline='') as file:
+            count=write_export(records, file, file_format)
+    print('exported '+str(count)+' records in '+format(time.perf_counter()-started,'.2f')+'s',file=sys.stderr)
+    return 0
 
 # test functions
 
+def benchmark_stages(maxdays_list):
+    stages={
+        'get_positions_raw':(get_positions_raw,{}),
+        'get_positions_formatted':(get_positions_formatted,{}),
+        'get_aspects':(get_aspects,{}),
+        'get_aspects[minor]':(get_aspects,{'minor':True}),
+    }
+    for maxdays in maxdays_list:
+        stages['get_transits[maxdays='+str(maxdays)+']']=(get_transits,{'maxdays':maxdays})
+        stages['get_aspect_transits[maxdays='+str(maxdays)+']']=(get_aspect_transits,{'maxdays':maxdays})
+        stages['get_aspect_transits[minor,maxdays='+str(maxdays)+']']=(get_aspect_transits,{'minor':True,'maxdays':maxdays})
+    return stages
+
+def benchmark_stage(function, kwargs, dates):
+    import swisseph as swe
+    import tracemalloc
+    calc_ut=swe.calc_ut
+    calls=0
+    def counted_calc_ut(*args):
+        nonlocal calls
+        calls+=1
+        return calc_ut(*args)
+    cold=[]
+    warm=[]
+    swe.calc_ut=counted_calc_ut
+    try:
+        for date in dates:
+            clear_result_cache()
+            clear_timelines()
+            start=time.perf_counter()
+            function(date,**kwargs)
+            cold.append(time.perf_counter()-start)
+            start=time.perf_counter()
+            function(date,**kwargs)
+            warm.append(time.perf_counter()-start)
+    finally:
+        swe.calc_ut=calc_ut
+    # memory is traced in a separate cold pass so tracing doesn't skew the timings
+    tracemalloc.start()
+    for date in dates:
+        clear_result_cache()
+        clear_timelines()
+        function(date,**kwargs)
+    peak_memory=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    clear_result_cache()
+    return {
+        'cold':sorted(cold)[len(cold)//2],
+        'cold_max':max(cold),
+        'warm':sorted(warm)[len(warm)//2],
+        'calc_ut_calls':calls/len(dates),
+        'peak_memory':peak_memory,
+    }
+
+def benchmark(dates=8, step=45, maxdays_list=(28,365), report_path=None, baseline_path=None, threshold=1.25, min_time=0.001, table=True):
+    global ephemeris_table, result_store_enabled
+    # cold timings have to compute every result instead of loading it from the store
+    result_store_enabled=False
+    if not table and ephemeris_table!=None:
+        close_ephemeris_table(ephemeris_table)
+        ephemeris_table=None
+    first_date=today()
+    dates=[first_date+timedelta(days=step*index) for index in range(dates)]
+    report={
+        'dates':[date.strftime('%Y-%m-%d') for date in dates],
+        'ephemeris_table':ephemeris_table!=None,
+        'stages':{},
+    }
+    for name, (function, kwargs) in benchmark_stages(maxdays_list).items():
+        result=benchmark_stage(function,kwargs,dates)
+        report['stages'][name]=result
+        print(
+            name+': cold '+format(result['cold']*1000,'.2f')+'ms'
+            +', warm '+format(result['warm']*1000,'.3f')+'ms'
+            +', '+format(result['calc_ut_calls'],'.0f')+' calc_ut calls'
+            +', '+format(result['peak_memory']/1024,'.0f')+'KiB peak'
+        )
+    if report_path!=None:
+        with open(report_path,'w') as file:
+            json.dump(report,file,indent=4)
+        print('benchmark report saved to '+report_path)
+    if baseline_path==None:
+        return 0
+    with open(baseline_path,'r') as file:
+        baseline=json.load(file)
+    regressions=0
+    for name, result in report['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        ratio=result['cold']/max(baseline['stages'][name]['cold'],1e-9)
+        # stages this fast are mostly timer noise
+        if ratio>threshold and result['cold']>=min_time:
+            regressions+=1
+            print(name+' is '+format(ratio,'.2f')+'x slower than the baseline',file=sys.stderr)
+    return 1 if regressions else 0
+
+class LoadTestClient:
+    # stands in for twitch.Client so setup_client's handlers run without logging in,
+    # recording when each reply would have been sent
+
+    def __init__(self, client_id):
+        from types import SimpleNamespace
+        self.client_id=client_id
+        self.events={}
+        self.replies={}
+        self.channel=SimpleNamespace(chat=self)
+        self.user=SimpleNamespace(id='0')
+        self.http=SimpleNamespace(get_token=lambda user_id: {'expire_in':seconds_in_1_day,'refresh_token':''})
+
+    def event(self, function):
+        self.events[function.__name__]=function
+        return function
+
+    async def send_message(self, message, reply_message_id=None):
+        self.replies.setdefault(reply_message_id,time.monotonic())
+
+def loadtest_scenarios(duration=10, rate=20, burst=200):
+    import random
+    # the same messages every run, so reports can be compared
+    generator=random.Random(0)
+    commands=list(get_commands()['commands'])
+    if get_commands()['natal']:
+        commands.append(get_commands()['natal'])
+    chatter=['hello','lol','what sign is the moon in','gg','!lurk']
+    steady=[]
+    for index in range(int(duration*rate)):
+        # most chat isn't commands, about one message in five is
+        text=generator.choice(commands) if generator.random()<0.2 else generator.choice(chatter)
+        steady.append((index/rate,text,str(generator.randrange(1000))))
+    return {
+        'steady':steady,
+        'burst':[(0,generator.choice(commands),str(index)) for index in range(burst)],
+        'duplicates':[(index/burst,commands[0],str(index)) for index in range(burst)],
+    }
+
+def load_loadtest_replay(replay_path):
+    # one JSON object per line with offset in seconds, text and optionally user_id
+    messages=[]
+    with open(replay_path,'r') as file:
+        for line in file:
+            if line.strip():
+                message=json.loads(line)
+                messages.append((message['offset'],message['text'],str(message.get('user_id','0'))))
+    return sorted(messages)
+
+def get_percentiles(values):
+    values=sorted(values)
+    if len(values)==0:
+        return {'p50':None,'p95':None,'p99':None,'max':None}
+    return {
+        'p50':values[int(len(values)*0.50)],
+        'p95':values[min(int(len(values)*0.95),len(values)-1)],
+        'p99':values[min(int(len(values)*0.99),len(values)-1)],
+        'max':values[-1],
+    }
+
+def format_milliseconds(seconds):
+    if seconds==None:
+        return '-'
+    return format(seconds*1000,'.1f')+'ms'
+
+async def loadtest_scenario(messages, drain_timeout=30, stall_interval=0.01, stall_threshold=0.005):
+    import asyncio
+    client, flow = setup_client(None,LoadTestClient)
+    ready=asyncio.create_task(client.events['on_ready']())
+    await asyncio.sleep(0)
+    sender=chat_senders[None]
+    stalls=[]
+
+    async def monitor():
+        while True:
+            before=time.monotonic()
+            await asyncio.sleep(stall_interval)
+            stalls.append(max(time.monotonic()-before-stall_interval,0))
+
+    received={}
+    handled={}
+
+    async def dispatch(message_id, text, user_id):
+        received[message_id]=time.monotonic()
+        await client.events['on_chat_message']({
+            'message_id':message_id,
+            'message':{'text':text},
+            'chatter_user_id':user_id,
+            'chatter_user_name':'viewer'+user_id,
+        })
+        handled[message_id]=time.monotonic()
+
+    monitor_task=asyncio.create_task(monitor())
+    start=time.monotonic()
+    tasks=[]
+    for index, (offset, text, user_id) in enumerate(messages):
+        delay=start+offset-time.monotonic()
+        if delay>0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(dispatch(str(index),text,user_id)))
+    await asyncio.gather(*tasks)
+    handled_time=time.monotonic()-start
+    # replies still queued behind the chat rate limit are reported as unsent
+    while len(sender.queue)!=0 and time.monotonic()-start<handled_time+drain_timeout:
+        await asyncio.sleep(0.05)
+    for task in (monitor_task,ready,sender.task):
+        if task!=None:
+            task.cancel()
+    clients.pop(None,None)
+    chat_senders.pop(None,None)
+    stats=sender.get_stats()
+    return {
+        'messages':len(messages),
+        'replies':len(client.replies),
+        'deduplicated':stats['deduplicated'],
+        'unsent':stats['queue_depth'],
+        'throughput':len(messages)/max(handled_time,1e-9),
+        'handled_latency':get_percentiles([handled[message_id]-received[message_id] for message_id in handled]),
+        'reply_latency':get_percentiles([sent-received[message_id] for message_id, sent in client.replies.items()]),
+        'stall_max':max(stalls,default=0),
+        # scheduling jitter below the threshold isn't a stall
+        'stall_total':sum(stall for stall in stalls if stall>=stall_threshold),
+    }
+
+def loadtest(scenarios=None, replay_path=None, duration=10, rate=20, burst=200, rate_limit=None, cold=False, report_path=None, drain_timeout=30):
+    import asyncio
+    global load_settings
+    all_scenarios=loadtest_scenarios(duration,rate,burst)
+    if replay_path!=None:
+        all_scenarios['replay']=load_loadtest_replay(replay_path)
+    if scenarios==None:
+        scenarios=list(all_scenarios)
+    # scenarios never announce, and can lift the chat rate limit to measure astrolobot alone
+    overrides={'announcements':False}
+    if rate_limit!=None:
+        overrides['chat_rate_limit']=rate_limit
+    settings_loader=load_settings
+    load_settings=lambda: settings_loader()|overrides
+    report={'scenarios':{}}
+    try:
+        for name in scenarios:
+            if cold:
+                clear_result_cache()
+                clear_timelines()
+            else:
+                prewarm()
+            result=asyncio.run(loadtest_scenario(all_scenarios[name],drain_timeout))
+            report['scenarios'][name]=result
+            print(
+                name+': '+str(result['messages'])+' messages at '+format(result['throughput'],'.0f')+'/s'
+                +', '+str(result['replies'])+' replies, '+str(result['deduplicated'])+' deduplicated, '+str(result['unsent'])+' unsent'
+                +', handled p50/p99 '+format_milliseconds(result['handled_latency']['p50'])+'/'+format_milliseconds(result['handled_latency']['p99'])
+                +', reply p50/p99 '+format_milliseconds(result['reply_latency']['p50'])+'/'+format_milliseconds(result['reply_latency']['p99'])
+                +', loop stall max '+format_milliseconds(result['stall_max'])+' total '+format_milliseconds(result['stall_total'])
+            )
+    finally:
+        load_settings=settings_loader
+    if report_path!=None:
+        with open(report_path,'w') as file:
+            json.dump(report,file,indent=4)
+        print('load test report saved to '+report_path)
+    return 0
+
 if __name__ == '__main__':
     def script_path():
         return path.dirname(__file__)+'/'
+    import argparse
+    parser=argparse.ArgumentParser(description=script_description())
+    subparsers=parser.add_subparsers(dest='command')
+    bench_parser=subparsers.add_parser('bench',help='time the astrology functions against the local ephemeris')
+    bench_parser.add_argument('--dates',type=int,default=8,help='number of dates to run each stage for')
+    bench_parser.add_argument('--step',type=int,default=45,help='days between benchmarked dates')
+    bench_parser.add_argument('--maxdays',type=int,nargs='+',default=[28,365],help='transit horizons to benchmark')
+    bench_parser.add_argument('--report',help='write the results to this JSON file')
+    bench_parser.add_argument('--baseline',help='fail if a stage is slower than in this JSON report')
+    bench_parser.add_argument('--threshold',type=float,default=1.25,help='allowed slowdown against the baseline')
+    bench_parser.add_argument('--min-time',type=float,default=0.001,help='ignore slowdowns of stages faster than this many seconds')
+    bench_parser.add_argument('--no-table',action='store_true',help='call calc_ut directly instead of using the ephemeris table')
+    loadtest_parser=subparsers.add_parser('loadtest',help='replay chat message storms against a stand-in twitch client')
+    loadtest_parser.add_argument('--scenarios',nargs='+',choices=['steady','burst','duplicates','replay'],help='scenarios to run, all of them by default')
+    loadtest_parser.add_argument('--replay',help='JSON lines file of messages with offset, text and user_id to run as the replay scenario')
+    loadtest_parser.add_argument('--duration',type=float,default=10,help='seconds of steady chat')
+    loadtest_parser.add_argument('--rate',type=float,default=20,help='messages per second of steady chat')
+    loadtest_parser.add_argument('--burst',type=int,default=200,help='messages in the burst and duplicates scenarios')
+    loadtest_parser.add_argument('--rate-limit',type=int,help='chat messages allowed per window instead of chat_rate_limit')
+    loadtest_parser.add_argument('--cold',action='store_true',help='clear the caches before each scenario instead of prewarming')
+    loadtest_parser.add_argument('--drain-timeout',type=float,default=30,help='seconds to wait for queued replies after the last message')
+    loadtest_parser.add_argument('--report',help='write the results to this JSON file')
+    export_parser=subparsers.add_parser('export',help='write positions, aspects and transit events for a date range')
+    export_parser.add_argument('--start',type=datetime.fromisoformat,help='UTC date or datetime to start at, today by default')
+    export_parser.add_argument('--days',type=float,default=365,help='number of days to export')
+    export_parser.add_argument('--step',type=float,default=24,help='hours between position and aspect samples')
+    export_parser.add_argument('--bodies',nargs='+',help='bodies to export, all of them by default')
+    export_parser.add_argument('--minor',action='store_true',help='use the minor aspects instead of the major ones')
+    export_parser.add_argument('--include',nargs='+',choices=export_kinds,default=export_kinds,help='record types to export')
+    export_parser.add_argument('--format',choices=['jsonl','csv'],default='jsonl',help='output format')
+    export_parser.add_argument('--output',help='write to this file instead of stdout')
+    export_parser.add_argument('--chunk-days',type=float,default=30,help='days computed by each worker at a time')
+    export_parser.add_argument('--processes',type=int,help='number of worker processes, one per CPU by default')
+    args=parser.parse_args()
+    if args.command=='export':
+        # keep setup messages out of an export written to stdout
+        stdout=sys.stdout
+        sys.stdout=sys.stderr
+        dependency_setup()
+        sys.stdout=stdout
+        if args.bodies!=None:
+            for name in args.bodies:
+                if name not in get_body_names():
+                    parser.error('unknown body '+repr(name)+', expected one of '+', '.join(get_body_names()))
+        sys.exit(export(args.start,args.days,args.step,args.bodies,args.minor,args.include,args.output,args.format,args.chunk_days,args.processes))
     dependency_setup()
+    if args.command=='loadtest':
+        if 'replay' in (args.scenarios or []) and args.replay==None:
+            parser.error('the replay scenario needs --replay')
+        sys.exit(loadtest(args.scenarios,args.replay,args.duration,args.rate,args.burst,args.rate_limit,args.cold,args.report,args.drain_timeout))
+    if args.command=='bench':
+        sys.exit(benchmark(args.dates,args.step,args.maxdays,args.report,args.baseline,args.threshold,args.min_time,not args.no_table))
     print(get_positions_formatted())
     print(get_transits_formatted())
     print(get_aspects_formatted())
     print(get_aspects_formatted(minor=True))
     print(get_aspect_transits_formatted())
     print(get_aspect_transits_formatted(minor=True))
-    main()
\ No newline at end of file
+    main()